@@ -0,0 +1,88 @@
+#######################################
+### Multi-codelist hospital admissions ###
+#######################################
+
+# Purpose: To classify emergency admissions against all of the avoidable hospitalisation codelists in one pass. The admitted_* variables in the study definition share the same date window and admission methods and differ only in their primary diagnosis codelist, so rather than filtering APCS once per variable, admissions are filtered once and each primary diagnosis is looked up once in the compiled codelist index (codelist_index.py), giving a bitmask with one bit per codelist. Adding another codelist subgroup adds one bit, not another scan. The admissions are then indexed by date (event_index.py), so each index date only counts the admissions in its own window rather than rescanning them all.
+
+
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+from event_index import EventIndex
+
+
+# Arguments that the shared scan understands (anything else needs its own evaluator)
+SUPPORTED = {"returning", "between", "on_or_before", "on_or_after", "with_admission_method", "with_these_primary_diagnoses", "return_expectations"}
+
+
+### 1. Group variables that can share a scan ###
+
+
+def scan_key(variable):
+    """Variables with the same window and admission methods can share one scan of APCS."""
+    unsupported = set(variable.kwargs) - SUPPORTED
+    if unsupported:
+        raise NotImplementedError("admitted_to_hospital({}) is not supported locally".format(", ".join(sorted(unsupported))))
+    return json.dumps({
+        "between": variable.kwargs.get("between"),
+        "on_or_before": variable.kwargs.get("on_or_before"),
+        "on_or_after": variable.kwargs.get("on_or_after"),
+        "with_admission_method": sorted(variable.kwargs.get("with_admission_method") or []),
+    }, sort_keys=True)
+
+
+def group_admissions(variables):
+    groups = OrderedDict()
+    for variable in variables:
+        if variable.function == "admitted_to_hospital":
+            groups.setdefault(scan_key(variable), []).append(variable)
+    return groups
+
+
+### 2. The shared scan ###
+
+
+class AdmissionsScan:
+    """One filtered view of APCS serving every admitted_to_hospital variable in a group."""
+
+    def __init__(self, variables, apcs, index, size):
+        self.variables = variables
+        first = variables[0]
+        methods = first.kwargs.get("with_admission_method")
+        keep = apcs["admission_method"].isin(methods).to_numpy() if methods else np.ones(len(apcs), dtype=bool)
+
+        # Each variable's codelist bit in the compiled index (-1, i.e. every bit, where any diagnosis counts)
+        self.masks = []
+        for variable in variables:
+            codelist = variable.kwargs.get("with_these_primary_diagnoses")
+            self.masks.append(index.bit(codelist.name) if codelist is not None else -1)
+
+        positions = apcs["_position"].to_numpy()[keep]
+        dates = apcs["admission_date"].to_numpy(dtype="datetime64[D]")[keep]
+        bits = index.lookup_many(apcs["primary_diagnosis"].to_numpy()[keep])
+
+        # Drop admissions that none of the variables can count
+        if all(mask != -1 for mask in self.masks):
+            relevant = bits != 0
+            positions, dates, bits = positions[relevant], dates[relevant], bits[relevant]
+
+        # Sorted by date once, with each codelist bit as a subset, so every window is two binary searches and a count of its own admissions
+        self.events = EventIndex(positions, dates, size, subsets={mask: (bits & mask) != 0 for mask in self.masks if mask != -1})
+
+    def evaluate(self, start, end, rolling=False):
+        """Return variable name -> array (one per patient) for admissions between start and end (slid on from the last window if rolling, see RollingCounts)."""
+        bounds = self.events.bounds(start, end)
+        results = OrderedDict()
+        for mask, variable in zip(self.masks, self.variables):
+            subset = None if mask == -1 else mask
+            counts = self.events.rolling(subset).count(bounds=bounds) if rolling else self.events.count(subset=subset, bounds=bounds)
+            returning = variable.kwargs.get("returning", "binary_flag")
+            if returning == "binary_flag":
+                results[variable.name] = (counts > 0).astype(int)
+            elif returning == "number_of_matches_in_period":
+                results[variable.name] = counts
+            else:
+                raise NotImplementedError("returning={!r} is not supported locally".format(returning))
+        return results
@@ -0,0 +1,211 @@
+#######################################
+### Benchmark the pipeline ###
+#######################################
+
+# Purpose: To time every stage of the project.yaml pipeline on dummy populations of increasing size (1k, 100k, 1M and 10M patients by default), so that changes which make a stage slower or hungrier show up locally before jobs are submitted. For each population size the pipeline is run in a scratch copy of the project, one stage at a time, recording for each stage:
+# - wall time and CPU time (user + system, including worker processes)
+# - peak resident memory (of the largest single process)
+# - bytes read from and written to disk (block I/O) and the size of the files the stage wrote
+# Results are saved as JSON. Given an earlier results file (--compare), a report of the change in each measurement is printed and saved next to it, with slowdowns beyond --tolerance flagged.
+
+# The cohort is generated with dummy_data.py, as generate_cohort needs the OpenSAFELY backend. Stages that need a tool that is not installed (R, cohortextractor) are recorded as skipped.
+
+# Example: python analysis/benchmark.py --sizes 1000 100000 --end 2019-12-01 --compare output/benchmarks/baseline.json
+
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+
+RESULTS_DIR = "output/benchmarks"
+SIZES = [1000, 100000, 1000000, 10000000]
+
+# Stages in pipeline order: (name, command, working directory within the scratch project, tool it needs)
+STAGES = [
+    ("generate_study_population", ["python", "analysis/dummy_data.py", "--patients", "{patients}", "--output-dir", "output/measures", "--format", "feather", "--end", "{end}"], ".", None),
+    ("generate_measures", ["cohortextractor", "generate_measures", "--study-definition", "study_definition", "--output-dir=output/measures"], ".", "cohortextractor"),
+    ("generate_measures_python", ["python", "analysis/measures.py", "--input-dir", "output/measures", "--output-dir", "output/measure_tables"], ".", None),
+    ("process_data", ["Rscript", "create_age_standardised_outputs.R"], "analysis", "Rscript"),
+    ("process_data_python", ["python", "analysis/standardise.py", "--input-dir", "output/measures", "--output-dir", "output/standardised", "--chunksize", "1000000"], ".", None),
+    ("describing_trends", ["Rscript", "describing_trends.R"], "analysis", "Rscript"),
+    ("describing_trends_part2", ["Rscript", "describing_trends_part2.R"], "analysis", "Rscript"),
+    ("describing_trends_part3", ["Rscript", "describing_trends_part3.R"], "analysis", "Rscript"),
+    ("describing_trends_part4", ["Rscript", "describing_trends_part4.R"], "analysis", "Rscript"),
+    ("describing_trends_part5", ["Rscript", "describing_trends_part5.R"], "analysis", "Rscript"),
+    ("dif_in_dif", ["Rscript", "dif_in_dif.R"], "analysis", "Rscript"),
+]
+
+# Measurements compared between runs (lower is better for all of them)
+METRICS = ["wall_seconds", "cpu_seconds", "peak_rss_bytes", "read_bytes", "written_bytes", "output_bytes"]
+
+# Timing differences smaller than this are treated as noise rather than regressions
+NOISE_SECONDS = 0.5
+
+
+### 1. Run one stage ###
+
+
+def run_stage(command, cwd, project):
+    """Run a command and measure it; returns (metrics, exit code)."""
+    before = _file_sizes(project)
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # wait4 gives the resources used by the stage and every worker process it waited for
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    after = _file_sizes(project)
+    metrics = {
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "peak_rss_bytes": usage.ru_maxrss * 1024,  # Reported in kilobytes on Linux
+        "read_bytes": usage.ru_inblock * 512,  # Blocks of 512 bytes
+        "written_bytes": usage.ru_oublock * 512,
+        "output_bytes": sum(size for path, size in after.items() if before.get(path) != size),
+    }
+    if process.returncode != 0:
+        metrics["error"] = stderr.decode(errors="replace")[-2000:]
+    return metrics, process.returncode
+
+
+def _file_sizes(project):
+    sizes = {}
+    for root, _, files in os.walk(os.path.join(project, "output")):
+        for name in files:
+            path = os.path.join(root, name)
+            sizes[path] = os.path.getsize(path)
+    return sizes
+
+
+### 2. Run the pipeline for each population size ###
+
+
+def scratch_project(directory):
+    """A copy of the project to run in: analysis/ is copied (the R scripts write relative to it) and codelists/ linked."""
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(os.path.join(directory, "output", "plots"))
+    shutil.copytree("analysis", os.path.join(directory, "analysis"), ignore=shutil.ignore_patterns("__pycache__"))
+    os.symlink(os.path.abspath("codelists"), os.path.join(directory, "codelists"))
+    return directory
+
+
+def run_pipeline(patients, end, directory, stages):
+    project = scratch_project(directory)
+    results = {}
+    failed = None
+    for name, command, cwd, tool in STAGES:
+        if stages and name not in stages:
+            continue
+        if tool and shutil.which(tool) is None:
+            results[name] = {"skipped": "{} is not installed".format(tool)}
+            continue
+        if failed:
+            results[name] = {"skipped": "{} failed".format(failed)}
+            continue
+        command = [sys.executable if part == "python" else part.format(patients=patients, end=end) for part in command]
+        print("{:>10} patients: {}".format(patients, name), flush=True)
+        results[name], returncode = run_stage(command, os.path.join(project, cwd), project)
+        if returncode != 0 and name == "generate_study_population":
+            failed = name
+    return results
+
+
+def machine():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": _git("rev-parse", "HEAD"),
+    }
+
+
+def _git(*args):
+    try:
+        return subprocess.run(["git"] + list(args), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+### 3. Compare with an earlier run ###
+
+
+def compare(current, baseline, tolerance):
+    """A plain-text report of each measurement against the baseline, and the number of regressions beyond tolerance."""
+    lines = ["Benchmark comparison: {} ({}) against {} ({})".format(
+        current["label"], current["machine"]["commit"], baseline["label"], baseline["machine"]["commit"]), ""]
+    regressions = 0
+    for size, stages in current["results"].items():
+        for stage, metrics in stages.items():
+            old = baseline["results"].get(size, {}).get(stage)
+            if not old or "skipped" in metrics or "skipped" in old:
+                continue
+            changes = []
+            for metric in METRICS:
+                if not old.get(metric):
+                    continue
+                ratio = metrics[metric] / old[metric]
+                flag = ""
+                noise = metric.endswith("_seconds") and metrics[metric] - old[metric] < NOISE_SECONDS
+                if metric in ("wall_seconds", "cpu_seconds", "peak_rss_bytes") and ratio > 1 + tolerance and not noise:
+                    flag = " REGRESSION"
+                    regressions += 1
+                changes.append("{} {} -> {} ({:+.0%}){}".format(metric, _show(old[metric], metric), _show(metrics[metric], metric), ratio - 1, flag))
+            lines.append("{:>10} {:<26} {}".format(size, stage, "; ".join(changes)))
+    lines += ["", "{} regression(s) beyond {:.0%}".format(regressions, tolerance)]
+    return "\n".join(lines), regressions
+
+
+def _show(value, metric):
+    if metric.endswith("_bytes"):
+        return "{:.1f}MB".format(value / 1e6)
+    return "{:.2f}s".format(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on dummy populations of increasing size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Numbers of patients")
+    parser.add_argument("--end", default="2022-04-01", help="Last month to generate (fewer months make a quicker run)")
+    parser.add_argument("--stages", nargs="+", help="Only run these stages (generate_study_population is always needed)")
+    parser.add_argument("--label", default=datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    parser.add_argument("--output-dir", default=RESULTS_DIR)
+    parser.add_argument("--compare", help="An earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Slowdown (or memory growth) to flag, as a fraction")
+    parser.add_argument("--keep", action="store_true", help="Keep each scratch project rather than deleting it")
+    args = parser.parse_args()
+
+    stages = set(args.stages) | {"generate_study_population"} if args.stages else None
+    results = {}
+    for patients in args.sizes:
+        directory = os.path.join(args.output_dir, "work", str(patients))
+        results[str(patients)] = run_pipeline(patients, args.end, directory, stages)
+        if not args.keep:
+            shutil.rmtree(directory)
+
+    current = {"label": args.label, "end": args.end, "machine": machine(), "results": results}
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, "{}.json".format(args.label))
+    with open(path, "w") as f:
+        json.dump(current, f, indent=2)
+    print("Saved", path)
+
+    if args.compare:
+        with open(args.compare) as f:
+            report, regressions = compare(current, json.load(f), args.tolerance)
+        with open(os.path.join(args.output_dir, "{}_comparison.txt".format(args.label)), "w") as f:
+            f.write(report + "\n")
+        print(report)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
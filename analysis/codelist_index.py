@@ -0,0 +1,103 @@
+#######################################
+### Compiled ICD-10 codelist index ###
+#######################################
+
+# Purpose: To match diagnosis codes against every ICD-10 codelist at once. The avoidable hospitalisation codelists hold 3- and 4-character codes that match by prefix (E11 matches E119), so they are compiled into a single character trie where each node records which codelists end there. Looking up a diagnosis walks its characters once, so the cost depends on the code length rather than the number of codelists or codes, and the result is a bitmask with one bit per codelist.
+
+# The compiled trie is cached in output/cache and only rebuilt when a codelist's pinned version (codelists/codelists.txt) or hash changes.
+
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+
+CODELISTS_TXT = "codelists/codelists.txt"
+CACHE_DIR = "output/cache"
+
+
+### 1. The trie ###
+
+
+class PrefixIndex:
+    """A trie over codes from several codelists; lookup returns a bitmask (bit j = names[j])."""
+
+    def __init__(self, codelists):
+        self.names = [codelist.name for codelist in codelists]
+        self.children = [{}]  # Node -> {character: child node}
+        self.bits = [0]  # Node -> codelists whose codes end at this node
+        for bit, codelist in enumerate(codelists):
+            for code in codelist.codes:
+                node = 0
+                for character in code:
+                    child = self.children[node].get(character)
+                    if child is None:
+                        child = len(self.children)
+                        self.children[node][character] = child
+                        self.children.append({})
+                        self.bits.append(0)
+                    node = child
+                self.bits[node] |= 1 << bit
+
+    def bit(self, name):
+        return 1 << self.names.index(name)
+
+    def lookup(self, code):
+        """Bitmask of every codelist containing a prefix of code."""
+        node, bits = 0, self.bits[0]
+        for character in code:
+            node = self.children[node].get(character)
+            if node is None:
+                break
+            bits |= self.bits[node]
+        return bits
+
+    def membership(self, code):
+        bits = self.lookup(code)
+        return {name: bool(bits >> j & 1) for j, name in enumerate(self.names)}
+
+    def lookup_many(self, codes):
+        """Vectorised lookup: each distinct code is walked once and the result broadcast back."""
+        unique, inverse = np.unique(np.asarray(codes, dtype=object).astype(str), return_inverse=True)
+        bits = np.fromiter((self.lookup(code) for code in unique), dtype=np.int64, count=len(unique))
+        return bits[inverse.reshape(-1)]
+
+
+### 2. Cache on disk ###
+
+
+def pinned_versions(path=CODELISTS_TXT):
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip() and not line.startswith("#")}
+
+
+def cache_key(codelists):
+    """Hash of each codelist's name, pinned version and content, so any change forces a rebuild."""
+    pinned = pinned_versions() if os.path.exists(CODELISTS_TXT) else set()
+    digest = hashlib.sha256()
+    for codelist in codelists:
+        if pinned and codelist.version not in pinned:
+            raise ValueError("{} ({}) is not pinned in {}; run `opensafely codelists update`".format(codelist.path, codelist.version, CODELISTS_TXT))
+        digest.update("{}|{}|{}|{}\n".format(codelist.name, codelist.version, codelist.sha, codelist.content_hash).encode())
+    return digest.hexdigest()
+
+
+def load_index(codelists, cache_dir=CACHE_DIR):
+    """Load the compiled index for these codelists from the cache, building it if anything has changed."""
+    codelists = list(codelists)
+    key = cache_key(codelists)
+    path = os.path.join(cache_dir, "icd10_index_{}.pickle".format(key[:16]))
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            index = pickle.load(f)
+        if getattr(index, "key", None) == key:
+            return index
+    index = PrefixIndex(codelists)
+    index.key = key
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    return index
@@ -0,0 +1,183 @@
+#######################################
+### Read and write cohort files ###
+#######################################
+
+# Purpose: To write cohort files in a typed, columnar format (Parquet or Arrow/Feather) and read any of the formats back, loading only the columns that are needed, either whole or as a stream of fixed-size chunks. Column types come from the study definition: binary flags become booleans, age becomes a small signed integer and counts small unsigned integers, and categorical variables (sex, region, ethnicity, imd_quintile, urban_rural) are dictionary encoded, so files are a fraction of the size of csv.gz and need no type inference when read.
+
+
+import pandas as pd
+
+
+FORMATS = ("csv", "csv.gz", "feather", "parquet")
+
+# returning= values that give a category
+CATEGORY_RETURNS = {"category", "nuts1_region_name", "rural_urban_classification", "group_6", "stp_code"}
+
+
+### 1. Column types from the study definition ###
+
+
+def column_type(variable):
+    """The storage type for a variable: bool, int16, uint16, int32 or category."""
+    returning = variable.kwargs.get("returning")
+    if variable.function in ("satisfying", "registered_as_of") or returning == "binary_flag":
+        return "bool"
+    if variable.function == "age_as_of":
+        return "int16"  # Signed: a patient registered before their date of birth has a negative age, which is still in the population (age <= 120)
+    if returning == "number_of_matches_in_period":
+        return "uint16"
+    if variable.function in ("categorised_as", "sex") or returning in CATEGORY_RETURNS:
+        return "category"
+    if returning == "index_of_multiple_deprivation":
+        return "int32"
+    raise ValueError("No storage type for {} (patients.{})".format(variable.name, variable.function))
+
+
+def column_types(study):
+    types = {"patient_id": "int64", "date": "date"}
+    types.update((v.name, column_type(v)) for v in study.output_variables)
+    return types
+
+
+def apply_types(cohort, study):
+    """Convert a cohort DataFrame to the study's column types (missing categories become nulls).
+
+    Columns that are already categorical keep their categories, so chunks written to the same file share one dictionary.
+    """
+    cohort = cohort.copy()
+    for column, dtype in column_types(study).items():
+        if column not in cohort.columns:
+            continue
+        if dtype == "category" and isinstance(cohort[column].dtype, pd.CategoricalDtype):
+            continue
+        if dtype == "category":
+            values = cohort[column].astype(object).where(cohort[column].notna(), "").astype(str)
+            cohort[column] = pd.Categorical(values.where(values != "", None))
+        elif dtype == "date":
+            cohort[column] = pd.to_datetime(cohort[column]).dt.date
+        elif dtype == "bool":
+            cohort[column] = cohort[column].astype(bool)
+        else:
+            cohort[column] = cohort[column].astype(dtype)
+    return cohort
+
+
+### 2. Write ###
+
+
+def output_format(path):
+    for extension in sorted(FORMATS, key=len, reverse=True):
+        if path.endswith("." + extension):
+            return extension
+    raise ValueError("Unknown cohort file format: {} (expected one of {})".format(path, ", ".join(FORMATS)))
+
+
+def _csv_flags(cohort):
+    # cohortextractor writes binary flags to csv as 0/1, not True/False
+    flags = cohort.select_dtypes("bool").columns
+    return cohort.astype({column: "int8" for column in flags}) if len(flags) else cohort
+
+
+def write_cohort(cohort, path, study):
+    fmt = output_format(path)
+    if fmt in ("csv", "csv.gz"):
+        _csv_flags(cohort).to_csv(path, index=False)
+        return
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(apply_types(cohort, study), preserve_index=False)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, path, compression="zstd")
+    else:
+        import pyarrow.feather as feather
+
+        feather.write_feather(table, path, compression="zstd")
+
+
+class CohortWriter:
+    """Write a cohort file one chunk at a time, so the whole file never has to be in memory.
+
+    with CohortWriter(path, study) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    """
+
+    def __init__(self, path, study):
+        self.path = path
+        self.study = study
+        self.format = output_format(path)
+        self._writer = None
+        self._schema = None
+
+    def write(self, chunk):
+        if self.format in ("csv", "csv.gz"):
+            # Gzip files can be appended to (each chunk is a separate gzip member)
+            _csv_flags(chunk).to_csv(self.path, index=False, mode="w" if self._schema is None else "a", header=self._schema is None)
+            self._schema = True
+            return
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(apply_types(chunk, self.study), schema=self._schema, preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+
+                self._writer = pq.ParquetWriter(self.path, table.schema, compression="zstd")
+            else:
+                self._writer = pa.ipc.new_file(self.path, table.schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+### 3. Read ###
+
+
+def read_cohort(path, columns=None):
+    """Read a cohort file in any supported format, optionally only some columns."""
+    fmt = output_format(path)
+    if fmt == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    if fmt == "feather":
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def iter_cohort(path, columns=None, chunksize=500000):
+    """Yield a cohort file as DataFrames of at most chunksize rows, so the whole file is never in memory.
+
+    Feather files are memory-mapped and read one record batch at a time; a batch is only decompressed when it is reached.
+    """
+    fmt = output_format(path)
+    if fmt in ("csv", "csv.gz"):
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield chunk
+        return
+    import pyarrow as pa
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            for start in range(0, batch.num_rows, chunksize):
+                yield batch.slice(start, chunksize).to_pandas()
@@ -0,0 +1,102 @@
+#######################################
+### Incremental extraction cache ###
+#######################################
+
+# Purpose: To avoid re-extracting everything when one part of the study definition changes. Each extracted column (one variable at one index date) is stored under a key that hashes everything it depends on: the variable's arguments, the pinned version and content of any codelist it uses, the keys of the variables it refers to, the index date (only for variables that depend on it), a fingerprint of the EHR tables and a hash of the extraction code (ENGINE_MODULES), so a fix to how columns are computed does not reuse columns computed before it. On a rerun, columns whose key is unchanged are read back from the cache and only invalidated variables and months are recomputed. For example, bumping the acute ACS codelist in codelists.txt only recomputes admitted_acs_acute.
+
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from definition import Codelist, Variable
+
+
+### 1. Keys ###
+
+# Modules whose code decides the values of extracted columns
+ENGINE_MODULES = ["admissions", "codelist_index", "column_cache", "definition", "ehr_tables", "event_index", "expressions", "longitudinal"]
+
+
+def engine_version(directory=os.path.dirname(os.path.abspath(__file__))):
+    """A hash of the source of ENGINE_MODULES, which changes whenever the extraction code does."""
+    digest = hashlib.sha256()
+    for module in ENGINE_MODULES:
+        with open(os.path.join(directory, module + ".py"), "rb") as f:
+            digest.update(module.encode() + b"\n" + f.read())
+    return digest.hexdigest()
+
+
+def _canonical(value, keys):
+    # A JSON-friendly description of an argument, with codelists and nested variables replaced by their identities
+    if isinstance(value, Codelist):
+        return {"codelist": value.version, "sha": value.sha, "content": value.content_hash}
+    if isinstance(value, Variable):
+        return {"variable": keys[value.name]}
+    if isinstance(value, dict):
+        return {str(k): _canonical(v, keys) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v, keys) for v in value]
+    return value
+
+
+def definition_keys(order, dependencies):
+    """Hash each variable's definition (and, through their keys, the definitions of everything it uses).
+
+    order is the variables in evaluation order and dependencies(variable) the names it refers to.
+    """
+    keys = {}
+    for variable in order:
+        description = {
+            "function": variable.function,
+            "args": _canonical(variable.args, keys),
+            "kwargs": _canonical({k: v for k, v in variable.kwargs.items() if k != "return_expectations"}, keys),
+            "uses": sorted(keys[name] for name in dependencies(variable)),
+        }
+        keys[variable.name] = hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+    return keys
+
+
+### 2. The cache ###
+
+
+class ColumnCache:
+    """Columns stored on disk by key, for one version of the EHR tables and of the extraction code.
+
+    hits counts the columns read back that were cached before this run (static columns written at the first index date and read at the others are not counted) and misses those computed.
+    """
+
+    def __init__(self, directory, data_version):
+        self.directory = directory
+        self.data_version = data_version
+        self.engine = engine_version()
+        self.started = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, definition_key, index_date=None):
+        """The key for a column: its definition, the data, the extraction code and (if it depends on it) the index date."""
+        parts = [definition_key, self.data_version, self.engine, str(index_date) if index_date is not None else "static"]
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npy")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        if os.stat(path).st_mtime < self.started:
+            self.hits += 1
+        return np.load(path, allow_pickle=True)
+
+    def put(self, key, values):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, np.asarray(values), allow_pickle=True)
+        os.replace(path + ".tmp", path)
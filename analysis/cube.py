@@ -0,0 +1,163 @@
+#######################################
+### Aggregated data cubes ###
+#######################################
+
+# Purpose: To hold the study population as counts rather than patient rows. Everything after extraction (the age- and sex-standardised trends and every Measure in the study definition) only uses counts by date, age group, sex, IMD quintile, region, urban/rural and ethnicity, so each month can be reduced to one small table (a "cube") with one row per combination of those dimensions, a population count and a count for each outcome measure. Any breakdown is then a roll-up (sum) over the dimensions it does not use.
+
+# A month of a few million patients becomes a few thousand cells, and because the cells are integer counts, cubes from different chunks or months can be added together exactly.
+
+
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+
+### 1. Definitions ###
+
+# Outcome measures (binary flags in the cohort files)
+MEASURES = ["admitted", "admitted_acs_all", "admitted_acs_acute", "admitted_acs_chronic", "admitted_acs_vaccine", "admitted_eucs"]
+
+# Output name -> cohort variable for each breakdown that is standardised
+BREAKDOWNS = {
+    "imd": "imd_quintile",
+    "region": "region",
+    "urbrur": "urban_rural",
+    "ethnicity": "ethnicity",
+}
+
+# Age groups as in age_standardise_month.R: cut(age, breaks = c(0,9,19,...,79,120), include.lowest = TRUE)
+AGE_BREAKS = [0, 9, 19, 29, 39, 49, 59, 69, 79, 120]
+AGE_GROUPS = ["0-9", "10-19", "20-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80+"]
+
+DIMENSIONS = ["date", "age_group", "sex"] + list(BREAKDOWNS.values())
+
+# Patient-level columns needed to build a cube (plus any other counts, see counts_for)
+INPUT_COLUMNS = ["age", "sex"] + list(BREAKDOWNS.values()) + MEASURES
+
+# Monthly cohort files (input_YYYY-MM-DD) or cubes already aggregated by longitudinal.py --cube-dir (cube_YYYY-MM-DD)
+INPUT_FILE = re.compile(r"(input|cube)_(\d{4}-\d{2}-\d{2})\.(csv|csv\.gz|feather|parquet)$")
+
+
+### 2. Build cubes ###
+
+
+def counts_for(study):
+    """The variables to count in a cube: the outcome measures plus the numerator of every Measure (e.g. gp_count)."""
+    counts = list(MEASURES)
+    for measure in study.measures:
+        if measure["numerator"] not in counts:
+            counts.append(measure["numerator"])
+    return counts
+
+
+def count_columns(cube):
+    return [column for column in cube.columns if column not in DIMENSIONS]
+
+
+def age_group(age):
+    age = np.asarray(age, dtype=float)
+    groups = np.searchsorted(AGE_BREAKS[1:-1], age, side="left")
+    labels = np.array(AGE_GROUPS, dtype=object)[np.minimum(groups, len(AGE_GROUPS) - 1)]
+    labels[(age < AGE_BREAKS[0]) | (age > AGE_BREAKS[-1]) | np.isnan(age)] = np.nan
+    return labels
+
+
+def aggregate(cohort, date=None, counts=MEASURES):
+    """Patient rows -> sums of each count (pop and, by default, each measure) by date, age group, sex and every breakdown."""
+    cube = pd.DataFrame({
+        "date": cohort["date"].astype(str).to_numpy() if date is None else date,
+        "age_group": age_group(cohort["age"]),
+        "sex": _as_text(cohort["sex"]),
+    })
+    for variable in BREAKDOWNS.values():
+        cube[variable] = _as_text(cohort[variable])
+    for count in counts:
+        cube[count] = cohort[count].fillna(0).to_numpy(dtype=np.int64)
+    cube["pop"] = 1
+    return cube.groupby(DIMENSIONS, dropna=False, sort=False).sum().reset_index()
+
+
+def _as_text(values):
+    # Categories may arrive as strings, numbers (csv) or dictionary-encoded (feather); group them as text
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        text = values.astype("Int64").astype(str)
+    else:
+        text = values.astype(object)
+    return text.where(values.notna() & (text != ""), None).to_numpy(dtype=object)
+
+
+def merge_cubes(cubes):
+    """Add together cubes of partial sums (e.g. from different chunks of the same month)."""
+    return pd.concat(cubes, ignore_index=True).groupby(DIMENSIONS, dropna=False, sort=False).sum().reset_index()
+
+
+def rollup(cube, by):
+    """Sum the counts over every dimension not in by."""
+    return cube.groupby(by, dropna=False, sort=False)[count_columns(cube)].sum().reset_index()
+
+
+### 3. Answer measures from a cube ###
+
+
+def measure_table(cube, measure):
+    """The table generate_measures would produce for one Measure (as read by definition.Study), before suppression.
+
+    group_by "population" means a single group over everyone (so the only count is the population itself), as in cohortextractor.
+    """
+    numerator, denominator = measure["numerator"], measure["denominator"]
+    if numerator not in cube.columns or denominator != "population":
+        raise ValueError("{}: only counts of {} over the population can be answered from this cube".format(measure["id"], ", ".join(count_columns(cube))))
+    group_by = [g for g in measure["group_by"] if g != "population"]
+    unknown = set(group_by) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError("{}: cannot group by {}; the cube only has {}".format(measure["id"], ", ".join(sorted(unknown)), ", ".join(DIMENSIONS)))
+    table = rollup(cube, group_by + ["date"])
+    table = table[group_by + [numerator, "pop", "date"]].rename(columns={"pop": denominator})
+    table["value"] = table[numerator] / table[denominator]
+    return table
+
+
+### 4. Save and load ###
+
+
+def write_cube(cube, path):
+    """Save a cube as csv, feather or parquet (chosen from the extension), with counts as integers and dimensions as text."""
+    cube = cube[DIMENSIONS + count_columns(cube)].reset_index(drop=True)
+    for column in count_columns(cube):
+        cube[column] = cube[column].astype(np.int64)
+    if path.endswith(".parquet"):
+        cube.to_parquet(path, index=False, compression="zstd")
+    elif path.endswith(".feather"):
+        cube.to_feather(path, compression="zstd")
+    else:
+        cube.to_csv(path, index=False)
+
+
+def read_cube(path):
+    if path.endswith(".parquet"):
+        cube = pd.read_parquet(path)
+    elif path.endswith(".feather"):
+        cube = pd.read_feather(path)
+    else:
+        cube = pd.read_csv(path, dtype={column: str for column in DIMENSIONS})
+    for column in DIMENSIONS:
+        cube[column] = cube[column].astype(object).where(cube[column].notna(), None)
+    return cube
+
+
+def cube_path(directory, date, fmt):
+    return os.path.join(directory, "cube_{}.{}".format(date, fmt))
+
+
+def input_files(directory):
+    """Every input_YYYY-MM-DD cohort file (or cube_YYYY-MM-DD cube) in a directory, in date order (one file per date, cubes first)."""
+    files = {}
+    for path in sorted(glob.glob(os.path.join(directory, "cube_*"))) + sorted(glob.glob(os.path.join(directory, "input_*"))):
+        match = INPUT_FILE.search(os.path.basename(path))
+        if match:
+            files.setdefault(match.group(2), path)
+    return [files[date] for date in sorted(files)]
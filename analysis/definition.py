@@ -0,0 +1,240 @@
+#######################################
+### Read the study definition ###
+#######################################
+
+# Purpose: To read analysis/study_definition.py without importing cohortextractor, so that the local tools (longitudinal extraction, dummy data, measures) all work from the same variable definitions that are run in OpenSAFELY. The file is parsed rather than executed, so each patients.* call is kept as a plain description (function name plus arguments).
+
+
+import ast
+import csv
+import datetime
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+
+STUDY_DEFINITION = "analysis/study_definition.py"
+CODELISTS_JSON = "codelists/codelists.json"
+
+
+### 1. Codelists ###
+
+
+class Codelist:
+    """A codelist loaded from codelists/, as codelist_from_csv would load it."""
+
+    def __init__(self, name, path, system, column, category_column=None):
+        self.name = name
+        self.path = path
+        self.system = system
+        self.column = column
+        self.category_column = category_column
+        self.categories = OrderedDict()  # Code -> category (or True where there is no category column)
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                code = row[column].strip()
+                if code:
+                    self.categories[code] = row[category_column] if category_column else True
+        self.version, self.sha = _codelist_version(path)
+        with open(path, "rb") as f:
+            self.content_hash = hashlib.sha1(f.read()).hexdigest()  # Changes if the local file is edited
+
+    @property
+    def codes(self):
+        return list(self.categories)
+
+    def __repr__(self):
+        return "Codelist({!r}, {} codes)".format(self.name, len(self.categories))
+
+
+def _codelist_version(path):
+    # Look up the pinned codelist id and sha recorded by `opensafely codelists update`
+    if not os.path.exists(CODELISTS_JSON):
+        return None, None
+    with open(CODELISTS_JSON) as f:
+        files = json.load(f)["files"]
+    entry = files.get(os.path.basename(path), {})
+    return entry.get("id"), entry.get("sha")
+
+
+### 2. Variables ###
+
+
+class Variable:
+    """A single patients.* call from the study definition.
+
+    Arguments that are themselves patients.* calls (the intermediates inside satisfying and categorised_as) are kept as nested Variables with hidden=True.
+    """
+
+    def __init__(self, name, function, args, kwargs, node, hidden=False):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.node = node
+        self.hidden = hidden
+
+    def arg(self, position, keyword, default=None):
+        """Return an argument that may be given positionally or by keyword."""
+        if keyword in self.kwargs:
+            return self.kwargs[keyword]
+        if len(self.args) > position:
+            return self.args[position]
+        return default
+
+    @property
+    def nested(self):
+        return [v for v in self.kwargs.values() if isinstance(v, Variable)]
+
+    @property
+    def return_expectations(self):
+        return self.kwargs.get("return_expectations", {})
+
+    def uses_index_date(self):
+        """True if any argument (other than return_expectations) refers to the index date."""
+        return _mentions_index_date([v for k, v in self.kwargs.items() if k != "return_expectations"] + list(self.args))
+
+    def __repr__(self):
+        return "Variable({!r}, patients.{})".format(self.name, self.function)
+
+
+def _mentions_index_date(value):
+    if isinstance(value, str):
+        return "index_date" in value
+    if isinstance(value, Variable):
+        return value.uses_index_date()
+    if isinstance(value, dict):
+        return any(_mentions_index_date(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(_mentions_index_date(v) for v in value)
+    return False
+
+
+### 3. Study ###
+
+
+class Study:
+    """The parsed study definition: constants, codelists, variables and measures."""
+
+    def __init__(self, path=STUDY_DEFINITION):
+        self.path = path
+        self.constants = {}
+        self.codelists = OrderedDict()
+        self.variables = OrderedDict()  # All variables, with hidden intermediates before the variable that uses them
+        self.measures = []
+        self.default_expectations = {}
+        self.index_date = None
+        self.population = None
+
+        with open(path) as f:
+            tree = ast.parse(f.read(), filename=path)
+        for statement in tree.body:
+            if not isinstance(statement, ast.Assign) or len(statement.targets) != 1:
+                continue
+            target = statement.targets[0]
+            if not isinstance(target, ast.Name):
+                continue
+            self._read_assignment(target.id, statement.value)
+
+    # a. Top-level assignments #
+
+    def _read_assignment(self, name, value):
+        if isinstance(value, ast.Call) and _call_name(value) == "codelist_from_csv":
+            args = [self._literal(a) for a in value.args]
+            kwargs = {k.arg: self._literal(k.value) for k in value.keywords}
+            self.codelists[name] = Codelist(
+                name,
+                path=args[0] if args else kwargs["filename"],
+                system=kwargs.get("system"),
+                column=kwargs.get("column", "code"),
+                category_column=kwargs.get("category_column"),
+            )
+        elif isinstance(value, ast.Call) and _call_name(value) == "StudyDefinition":
+            self._read_study(value)
+        elif isinstance(value, ast.List) and name == "measures":
+            self.measures = [self._read_measure(m) for m in value.elts if isinstance(m, ast.Call)]
+        else:
+            try:
+                self.constants[name] = ast.literal_eval(value)
+            except ValueError:
+                pass
+
+    def _read_study(self, call):
+        for keyword in call.keywords:
+            if keyword.arg == "default_expectations":
+                self.default_expectations = self._literal(keyword.value)
+            elif keyword.arg == "index_date":
+                self.index_date = self._literal(keyword.value)
+            else:
+                variable = self._read_variable(keyword.arg, keyword.value)
+                if keyword.arg == "population":
+                    variable.hidden = True
+                    self.population = variable
+
+    def _read_variable(self, name, call, hidden=False):
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)):
+            raise ValueError("{}: expected a patients.* call".format(name))
+        args = [self._literal(a) for a in call.args]
+        kwargs = OrderedDict()
+        for keyword in call.keywords:
+            if isinstance(keyword.value, ast.Call) and isinstance(keyword.value.func, ast.Attribute):
+                kwargs[keyword.arg] = self._read_variable(keyword.arg, keyword.value, hidden=True)
+            else:
+                kwargs[keyword.arg] = self._literal(keyword.value)
+        variable = Variable(name, call.func.attr, args, kwargs, call, hidden=hidden)
+        self.variables[name] = variable
+        return variable
+
+    def _read_measure(self, call):
+        measure = {k.arg: self._literal(k.value) for k in call.keywords}
+        group_by = measure.get("group_by", "population")
+        measure["group_by"] = [group_by] if isinstance(group_by, str) else list(group_by)
+        measure.setdefault("small_number_suppression", False)
+        return measure
+
+    def _literal(self, node):
+        # Names refer to module-level constants or codelists (e.g. index_date, acs_codes_all)
+        if isinstance(node, ast.Name):
+            if node.id in self.codelists:
+                return self.codelists[node.id]
+            if node.id in self.constants:
+                return self.constants[node.id]
+            raise ValueError("Unknown name in study definition: {}".format(node.id))
+        return ast.literal_eval(node)
+
+    # b. Helpers for the local tools #
+
+    @property
+    def output_variables(self):
+        """Variables written to the cohort file (cohortextractor leaves out hidden intermediates)."""
+        return [v for v in self.variables.values() if not v.hidden]
+
+    def index_dates(self, start=None, end=None, days=None):
+        """Monthly index dates, matching --index-date-range "<index_date> to <end_date> by month" (or every given number of days)."""
+        start = _to_date(start or self.index_date)
+        end = _to_date(end or self.constants["end_date"])
+        dates = []
+        while start <= end:
+            dates.append(start)
+            start = start + datetime.timedelta(days=days) if days else add_months(start, 1)
+        return dates
+
+
+def _call_name(call):
+    return call.func.id if isinstance(call.func, ast.Name) else call.func.attr
+
+
+def add_months(date, months):
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1)
+
+
+def _to_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value)
+
+
+def load_study(path=STUDY_DEFINITION):
+    return Study(path)
@@ -0,0 +1,117 @@
+#######################################
+### Disclosure control ###
+#######################################
+
+# Purpose: To apply the OpenSAFELY disclosure rules to released tables in one place, as array operations over every count column at once:
+# - Rounding: counts are rounded to the nearest 5
+# - Primary suppression: small counts are removed
+# - Secondary suppression: within each set of cells that add up to a published total (e.g. the IMD quintiles for one sex and month add up to that month's total in sex_trends.csv), if the removed counts could be worked out from the total, the smallest remaining count is removed too. Which groups are exposed depends on the table:
+#   - Rounded tables (the standardised trends): the removed counts can be worked out if only one was removed, or if what they add up to pins every one of them (after rounding each is 0 or 5, so a removed total of 0, or of 5 for every cell removed). See is_pinned
+#   - Measure tables (not rounded): cohortextractor's rule, that some were removed and they add up to 5 or less. See is_small_total
+# - Linked columns: anything calculated from a removed count (e.g. its iexp_ and dexp_ expected counts) is removed with it
+
+
+import numpy as np
+
+
+ROUNDING = 5
+THRESHOLD = 5
+
+
+### 1. Rounding and primary suppression ###
+
+
+def round_counts(values, accuracy=ROUNDING):
+    """plyr::round_any: round to the nearest multiple of accuracy."""
+    return np.round(np.asarray(values, dtype=float) / accuracy) * accuracy
+
+
+def primary(values, threshold=THRESHOLD, zero=True):
+    """Mask of counts at or below the threshold (zero=False leaves zeros, as cohortextractor does)."""
+    values = np.asarray(values, dtype=float)
+    small = values <= threshold
+    if not zero:
+        small &= values > 0
+    return small
+
+
+### 2. Secondary suppression ###
+
+
+def groups_of(table, by):
+    """Integer id of the published total each row contributes to (rows with the same values of by)."""
+    if not by:
+        return np.zeros(len(table), dtype=np.int64)
+    return table.groupby(by, dropna=False, sort=False).ngroup().to_numpy()
+
+
+def secondary(values, suppressed, groups, threshold=THRESHOLD, zero=True, exposes=None):
+    """Extend a suppression mask so that no total reveals what was removed.
+
+    values and suppressed are (rows x columns); groups gives each row's total. In every group and column that exposes what was removed (exposes(removed_total, removed_cells, threshold, lowest), is_pinned by default), the smallest count above the threshold is removed as well. zero=False means zeros were left in (so each removed count is at least 1).
+    """
+    exposes = exposes or is_pinned
+    values = np.asarray(values, dtype=float)
+    suppressed = np.array(suppressed, dtype=bool)
+    if values.ndim == 1:
+        return secondary(values[:, None], suppressed[:, None], groups, threshold, zero, exposes)[:, 0]
+    groups = np.asarray(groups)
+    size = groups.max() + 1 if len(groups) else 0
+    for j in range(values.shape[1]):
+        column, removed = values[:, j], suppressed[:, j]
+        removed_total = np.bincount(groups, weights=np.where(removed, np.nan_to_num(column), 0), minlength=size)
+        removed_cells = np.bincount(groups, weights=removed, minlength=size)
+        exposed = exposes(removed_total, removed_cells, threshold, lowest=0 if zero else 1)
+        candidates = np.flatnonzero(exposed[groups] & ~removed & (column > threshold))
+        if len(candidates):
+            # The smallest candidate in each group
+            order = candidates[np.lexsort((column[candidates], groups[candidates]))]
+            first = np.append(True, groups[order][1:] != groups[order][:-1])
+            removed[order[first]] = True
+    return suppressed
+
+
+def is_pinned(removed_total, removed_cells, threshold=THRESHOLD, lowest=0):
+    """Whether the removed cells of each group can be worked out from its total.
+
+    A single removed cell always can. Several can only if their total is the smallest or largest it could be, so that every one of them must be lowest or must be the threshold (after rounding each is 0 or 5, so a total of 0 or of 5 per cell).
+    """
+    removed_total = np.asarray(removed_total, dtype=float)
+    removed_cells = np.asarray(removed_cells, dtype=float)
+    several = (removed_total == lowest * removed_cells) | (removed_total == threshold * removed_cells)
+    return (removed_cells == 1) | ((removed_cells > 1) & several)
+
+
+def is_small_total(removed_total, removed_cells, threshold=THRESHOLD, lowest=1):
+    """cohortextractor's rule for measure tables: a group is exposed if any cells were removed and they add up to the threshold or less."""
+    removed_total = np.asarray(removed_total, dtype=float)
+    removed_cells = np.asarray(removed_cells, dtype=float)
+    return (removed_cells > 0) & (removed_total <= threshold)
+
+
+### 3. Apply to a table ###
+
+
+def protect(table, counts, totals, linked=None, population=None, zero=True, exposes=None):
+    """Primary, secondary and linked suppression of the count columns of a table (already rounded if required).
+
+    totals are the columns identifying each published total (see groups_of), or None if the rows do not add up to anything published (primary suppression only). linked maps a count column to the columns calculated from it. If population is given, rows where it is suppressed are dropped entirely (with their counts treated as removed). exposes is the secondary suppression rule (see secondary).
+    """
+    table = table.copy()
+    groups = None if totals is None else groups_of(table, totals)
+    dropped = np.zeros(len(table), dtype=bool)
+    if population is not None:
+        pop = table[population].to_numpy(dtype=float)
+        dropped = primary(pop, zero=zero)
+        if groups is not None:
+            dropped = secondary(pop, dropped, groups, zero=zero, exposes=exposes)
+    values = table[counts].to_numpy(dtype=float)
+    suppressed = primary(values, zero=zero) | dropped[:, None]
+    if groups is not None:
+        suppressed = secondary(values, suppressed, groups, zero=zero, exposes=exposes)
+    for j, column in enumerate(counts):
+        table.loc[suppressed[:, j], column] = np.nan
+        for other in (linked or {}).get(column, []):
+            if other in table.columns:
+                table.loc[suppressed[:, j], other] = np.nan
+    return table[~dropped]
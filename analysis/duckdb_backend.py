@@ -0,0 +1,453 @@
+#######################################
+### Local DuckDB backend ###
+#######################################
+
+# Purpose: To run the study definition against a local DuckDB database of EHR tables (e.g. from synthetic_ehr.py), so that extraction queries can be tested and their performance worked on outside the secure environment. Rather than one query per variable per month, the whole study definition is compiled into a single SQL statement covering every index date:
+# - a months table holds every index date with each date the variables look at (e.g. last_day_of_month(index_date)), shared by every variable
+# - each admissions filter (e.g. the emergency admission methods) is one common table expression, and each distinct primary diagnosis is matched against every ICD-10 codelist once; every admitted_to_hospital variable with the same window is answered by one grouped join of the two
+# - each other variable is a grouped join of its table with the months (or, if it does not depend on the index date, of its table alone), so coded events, registrations and addresses are read once for all months
+# - satisfying and categorised_as become SQL expressions, so the population condition is a filter
+# - the cube (see cube.py) and every Measure are GROUPING SETS of the one query, so patient rows are never sent back from the database
+# The cubes are written as longitudinal.py --cube-dir writes them, and the measures as measures.py writes them (with the same small number suppression).
+
+# The SQL follows the local extraction engine (longitudinal.py) for each variable, so the two give the same cubes; --sql saves the compiled statement and --profile saves DuckDB's query profile (JSON) to see where the time goes.
+
+# Example: python analysis/duckdb_backend.py --tables-dir output/ehr --database output/ehr.duckdb --cube-dir output/cubes --measures-dir output/measure_tables
+
+
+import argparse
+import os
+from collections import OrderedDict
+
+import expressions
+from admissions import group_admissions, scan_key
+from cohort_io import column_type
+from cube import AGE_BREAKS, AGE_GROUPS, DIMENSIONS, counts_for, cube_path, write_cube
+from definition import STUDY_DEFINITION, load_study
+from ehr_tables import DATE_COLUMNS, TABLES, TEXT_COLUMNS, read_table, table_path, tables_version
+from longitudinal import dependencies, resolve_date
+from measures import suppress, write_measures
+
+
+# Order each table is sorted in (as longitudinal.py), so "last" and "first" rows match it
+SORT_COLUMNS = ["patient_id", "date", "admission_date", "start_date"]
+
+# Columns that are numbers but not whole numbers (every other non-date, non-text column is an integer)
+NUMERIC_COLUMNS = {"index_of_multiple_deprivation"}
+
+
+### 1. Load the tables ###
+
+
+def connect(tables_dir, database=":memory:", threads=None):
+    """A DuckDB connection with every EHR table loaded (a database file is only reloaded when the table files change)."""
+    import duckdb
+
+    connection = duckdb.connect(database)
+    if threads:
+        connection.execute("SET threads = {:d}".format(threads))
+    version = tables_version(tables_dir)
+    connection.execute("CREATE TABLE IF NOT EXISTS _tables_version (version VARCHAR)")
+    if connection.execute("SELECT version FROM _tables_version").fetchall() != [(version,)]:
+        for name in TABLES:
+            load_table(connection, tables_dir, name)
+        connection.execute("DELETE FROM _tables_version")
+        connection.execute("INSERT INTO _tables_version VALUES (?)", [version])
+    return connection
+
+
+def load_table(connection, directory, name):
+    """Copy one table into the database with its columns typed, and a _row number in the order longitudinal.py sorts it."""
+    path = table_path(directory, name)
+    if path.endswith(".feather"):
+        connection.register("_feather", read_table(directory, name))
+        source = "_feather"
+    elif path.endswith(".parquet"):
+        source = "read_parquet({})".format(_quote(path))
+    else:
+        source = "read_csv({}, header = true, all_varchar = true)".format(_quote(path))
+    columns = []
+    for column in TABLES[name]:
+        if column in DATE_COLUMNS:
+            columns.append("CAST(TRY_CAST({0} AS TIMESTAMP) AS DATE) AS {0}".format(column))
+        elif column in TEXT_COLUMNS:
+            columns.append("COALESCE(CAST({0} AS VARCHAR), '') AS {0}".format(column))
+        elif column in NUMERIC_COLUMNS:
+            columns.append("CAST({0} AS DOUBLE) AS {0}".format(column))
+        else:
+            columns.append("CAST({0} AS BIGINT) AS {0}".format(column))
+    order = ", ".join(c + " NULLS LAST" for c in SORT_COLUMNS if c in TABLES[name])
+    connection.execute("""
+        CREATE OR REPLACE TABLE {name} AS
+        SELECT {columns}, row_number() OVER (ORDER BY {order}, _file_row) AS _row
+        FROM (SELECT *, row_number() OVER () AS _file_row FROM {source})
+    """.format(name=name, columns=", ".join(columns), order=order, source=source))
+    if source == "_feather":
+        connection.unregister("_feather")
+
+
+def _quote(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def _name(value):
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+### 2. Compile the study definition ###
+
+
+class Plan:
+    """The whole study definition over a list of index dates, as one SQL statement returning the cube and every measure.
+
+    Variables are only compiled if the population, the cube or a measure needs them.
+    """
+
+    def __init__(self, study, index_dates, measures=None):
+        self.study = study
+        self.index_dates = [str(d) for d in index_dates]
+        # As in cohortextractor, a later measure with the same id replaces an earlier one
+        self.measures = list({m["id"]: m for m in (study.measures if measures is None else measures)}.values())
+        self.counts = list(counts_for(study))
+        for measure in self.measures:
+            for count in (measure["numerator"], measure["denominator"]):
+                if count != "population" and count not in self.counts:
+                    self.counts.append(count)
+        self.keys = [d for d in DIMENSIONS if d != "date"]
+        for measure in self.measures:
+            self.keys += [k for k in measure["group_by"] if k != "population" and k not in self.keys]
+        self.sets = [tuple(self.keys[:len(DIMENSIONS) - 1])] + [tuple(k for k in m["group_by"] if k != "population") for m in self.measures]
+
+        self.dates = OrderedDict()  # Date expression (e.g. last_day_of_month(index_date)) -> months column
+        self.ctes = OrderedDict()  # Name -> SQL
+        self.joins = []  # (CTE name, varying) joined onto every patient and month
+        self.columns = OrderedDict()  # Variable name -> SQL for its value in the cohort
+        self._admissions = {}
+        self._filters = {}
+        self._icd10 = OrderedDict()  # ICD-10 codelists the admissions use, by name
+        needed = self._needed(["population"] + [k for k in self.keys if k != "age_group"] + ["age"] + self.counts)
+        for name in needed:
+            variable = study.variables[name]
+            if variable.function not in ("satisfying", "categorised_as"):
+                self._compile(variable)
+
+    def _needed(self, names):
+        order = []
+
+        def visit(name):
+            if name in order:
+                return
+            for dependency in dependencies(self.study.variables[name]):
+                visit(dependency)
+            order.append(name)
+
+        for name in names:
+            visit(name)
+        return order
+
+    # a. Dates and scans #
+
+    def date(self, value):
+        """SQL for a study definition date: a months column if it depends on the index date, otherwise a literal."""
+        if "index_date" not in value:
+            return "DATE {}".format(_quote(resolve_date(value, None)))
+        if value not in self.dates:
+            self.dates[value] = "d{}".format(len(self.dates))
+        return "m." + self.dates[value]
+
+    def window(self, variable, column):
+        """A condition on a date column for a variable's between / on_or_before / on_or_after."""
+        if "between" in variable.kwargs:
+            start, end = variable.kwargs["between"]
+        else:
+            start, end = variable.kwargs.get("on_or_after"), variable.kwargs.get("on_or_before")
+        condition = ["{} IS NOT NULL".format(column)]
+        if start:
+            condition.append("{} >= {}".format(column, self.date(start)))
+        if end:
+            condition.append("{} <= {}".format(column, self.date(end)))
+        return " AND ".join(condition)
+
+    def scan(self, name, table, condition, values, varying, joins="", group=True):
+        """A CTE of one row per patient (and index date, if varying) with the named values, from a table's rows that meet the condition."""
+        keys = "t.patient_id, m.index_date" if varying else "t.patient_id"
+        source = "{} t {}JOIN months m ON {}".format(table, joins, condition) if varying else "{} t {}WHERE {}".format(table, joins, condition)
+        selected = ", ".join("{} AS {}".format(sql, _name(value)) for value, sql in values.items())
+        self.ctes[name] = "SELECT {}, {} FROM {}{}".format(keys, selected, source, " GROUP BY {}".format(keys) if group else "")
+        self.joins.append((name, varying))
+
+    def _covering(self, date):
+        return "t.start_date <= {0} AND (t.end_date IS NULL OR t.end_date >= {0})".format(date)
+
+    # b. Variables #
+
+    def _compile(self, variable):
+        name, function, varying = variable.name, variable.function, variable.uses_index_date()
+        cte = "v_" + name
+        returning = variable.kwargs.get("returning", "binary_flag")
+        default = "''" if column_type(variable) == "category" else "0"
+
+        if function == "registered_as_of":
+            self.scan(cte, "registrations", self._covering(self.date(variable.arg(0, "reference_date"))), {name: "1"}, varying)
+        elif function == "died_from_any_cause":
+            self.scan(cte, "patients", self.window(variable, "t.date_of_death"), {name: "1"}, varying)
+        elif function == "age_as_of":
+            date = self.date(variable.arg(0, "reference_date"))
+            age = "year({0}) - year(t.date_of_birth) - CASE WHEN month(t.date_of_birth) > month({0}) OR (month(t.date_of_birth) = month({0}) AND day(t.date_of_birth) > day({0})) THEN 1 ELSE 0 END".format(date)
+            self.scan(cte, "patients", "TRUE", {name: age}, varying, group=False)
+        elif function == "sex":
+            self.scan(cte, "patients", "TRUE", {name: "t.sex"}, varying, group=False)
+        elif function == "with_these_clinical_events":
+            codelist = self.codelist(variable.arg(0, "codelist"))
+            if returning == "category":
+                value = "{}(c.category, t._row)".format("arg_min" if variable.kwargs.get("find_first_match_in_period") else "arg_max")
+            else:
+                value = _returning_count(returning)
+            self.scan(cte, "clinical_events", self.window(variable, "t.date"), {name: value}, varying, joins="JOIN {} c ON t.ctv3_code = c.code ".format(codelist))
+        elif function == "with_ethnicity_from_sus":
+            # Most frequent code per patient (ties go to the lowest code)
+            self.ctes[cte] = (
+                "SELECT patient_id, group_6 AS {} FROM (SELECT patient_id, group_6, count(*) AS n FROM sus_ethnicity WHERE group_6 != '' GROUP BY ALL) "
+                "QUALIFY row_number() OVER (PARTITION BY patient_id ORDER BY n DESC, group_6) = 1".format(_name(name))
+            )
+            self.joins.append((cte, False))
+        elif function == "registered_practice_as_of":
+            # Rows are numbered in start date order, so the latest registration wins
+            self.scan(cte, "registrations", self._covering(self.date(variable.arg(0, "date"))), {name: "arg_max(t.region, t._row)"}, varying)
+        elif function == "address_as_of":
+            value = "arg_max(t.{}, t._row)".format(returning)
+            if returning == "index_of_multiple_deprivation":
+                step = variable.kwargs.get("round_to_nearest")
+                value = "CAST(trunc(round({} / {step}) * {step}) AS BIGINT)".format(value, step=step) if step else "CAST(trunc({}) AS BIGINT)".format(value)
+            self.scan(cte, "addresses", self._covering(self.date(variable.arg(0, "date"))), {name: value}, varying)
+        elif function == "with_gp_consultations":
+            self.scan(cte, "gp_consultations", self.window(variable, "t.date"), {name: _returning_count(returning)}, varying)
+        elif function == "admitted_to_hospital":
+            cte = self.admissions(variable)
+        else:
+            raise NotImplementedError("patients.{} is not supported by the DuckDB backend".format(function))
+        self.columns[name] = "COALESCE({}.{}, {})".format(cte, _name(name), default)
+
+    def codelist(self, codelist):
+        """A CTE of a codelist's codes (and categories)."""
+        name = "codelist_" + codelist.name
+        if name not in self.ctes:
+            rows = ", ".join("({}, {})".format(_quote(code), _quote(category if category is not True else "")) for code, category in codelist.categories.items())
+            self.ctes[name] = "SELECT * FROM (VALUES {}) AS codes(code, category)".format(rows)
+        return name
+
+    def admissions(self, variable):
+        """The CTE answering every admitted_to_hospital variable with the same window and admission methods."""
+        key = scan_key(variable)
+        if key in self._admissions:
+            return self._admissions[key]
+        group = group_admissions(self.study.variables.values())[key]
+        methods = variable.kwargs.get("with_admission_method")
+        # One filter per set of admission methods, shared by every window that uses it
+        methods_key = tuple(sorted(methods or []))
+        if methods_key not in self._filters:
+            self._filters[methods_key] = "admissions_{}".format(len(self._filters))
+            where = "WHERE admission_method IN ({})".format(", ".join(_quote(m) for m in methods_key)) if methods else ""
+            self.ctes[self._filters[methods_key]] = "SELECT patient_id, admission_date, primary_diagnosis FROM apcs {}".format(where)
+        values = OrderedDict()
+        for member in group:
+            codelist = member.kwargs.get("with_these_primary_diagnoses")
+            matches = "d.{} IS TRUE".format(_name(self.diagnoses(codelist))) if codelist is not None else "TRUE"
+            returning = member.kwargs.get("returning", "binary_flag")
+            if returning == "binary_flag":
+                values[member.name] = "max(CASE WHEN {} THEN 1 ELSE 0 END)".format(matches)
+            elif returning == "number_of_matches_in_period":
+                values[member.name] = "count(*) FILTER (WHERE {})".format(matches)
+            else:
+                raise NotImplementedError("returning={!r} is not supported by the DuckDB backend".format(returning))
+        name = "admitted_{}".format(len(self._admissions))
+        self.scan(name, self._filters[methods_key], self.window(variable, "t.admission_date"), values, variable.uses_index_date(), joins="LEFT JOIN diagnoses d ON d.diagnosis = t.primary_diagnosis ")
+        self._admissions[key] = name
+        return name
+
+    def diagnoses(self, codelist):
+        """The diagnoses column for an ICD-10 codelist: each distinct primary diagnosis is matched by prefix against every codelist once (see sql)."""
+        self._icd10[codelist.name] = codelist
+        return codelist.name
+
+    # c. Expressions #
+
+    def expression(self, name):
+        """SQL for a variable's value in the cohort: a joined column, or a satisfying / categorised_as expression over them."""
+        variable = self.study.variables[name]
+        if variable.function == "satisfying":
+            return "CASE WHEN {} THEN 1 ELSE 0 END".format(self.condition(expressions._fold(expressions.parse(variable.arg(0, "expression")))))
+        if variable.function == "categorised_as":
+            categories = variable.arg(0, "category_definitions")
+            default = next((k for k, v in categories.items() if v.strip() == "DEFAULT"), "")
+            rules = " ".join("WHEN {} THEN {}".format(self.condition(expressions._fold(expressions.parse(v))), _quote(k)) for k, v in categories.items() if v.strip() != "DEFAULT")
+            return "CASE {} ELSE {} END".format(rules, _quote(default)) if rules else _quote(default)
+        return "c." + _name(name)
+
+    def condition(self, tree):
+        """A boolean SQL expression for an expression tree, with a bare value true when non-zero / non-empty (as expressions.py)."""
+        kind = tree[0]
+        if kind in ("AND", "OR"):
+            return "({} {} {})".format(self.condition(tree[1]), kind, self.condition(tree[2]))
+        if kind == "NOT":
+            return "(NOT {})".format(self.condition(tree[1]))
+        if kind in ("=", "!=", "<", "<=", ">", ">="):
+            return "({} {} {})".format(self.value(tree[1]), kind, self.value(tree[2]))
+        empty = "''" if self._is_text(tree) else "0"
+        return "({} != {})".format(self.value(tree), empty)
+
+    def value(self, tree):
+        kind = tree[0]
+        if kind == "number":
+            return repr(tree[1])
+        if kind == "string":
+            return _quote(tree[1])
+        if kind == "name":
+            return "({})".format(self.expression(tree[1]))
+        if kind in ("+", "-", "*", "/"):
+            return "({} {} {})".format(self.value(tree[1]), kind, self.value(tree[2]))
+        return "(CASE WHEN {} THEN 1 ELSE 0 END)".format(self.condition(tree))
+
+    def _is_text(self, tree):
+        if tree[0] == "string":
+            return True
+        return tree[0] == "name" and column_type(self.study.variables[tree[1]]) == "category"
+
+    # d. The statement #
+
+    def sql(self):
+        months = ", ".join(
+            "({})".format(", ".join(["DATE " + _quote(d)] + ["DATE " + _quote(resolve_date(value, d)) for value in self.dates]))
+            for d in self.index_dates
+        )
+        ctes = ["months(index_date{}) AS (VALUES {})".format("".join(", " + c for c in self.dates.values()), months)]
+        if self._icd10:
+            codes = ", ".join("({}, {})".format(_quote(name), _quote(code)) for name, codelist in self._icd10.items() for code in codelist.codes)
+            ctes.append("icd10_codes AS (SELECT * FROM (VALUES {}) AS codes(list, code))".format(codes))
+            matched = ", ".join("bool_or(c.list = {}) AS {}".format(_quote(name), _name(name)) for name in self._icd10)
+            ctes.append(
+                "diagnoses AS (SELECT e.primary_diagnosis AS diagnosis, {} FROM (SELECT DISTINCT primary_diagnosis FROM apcs) e "
+                "JOIN icd10_codes c ON starts_with(e.primary_diagnosis, c.code) GROUP BY 1)".format(matched)
+            )
+        ctes += ["{} AS ({})".format(name, sql) for name, sql in self.ctes.items()]
+        joins = "".join(
+            " LEFT JOIN {0} ON {0}.patient_id = p.patient_id{1}".format(name, " AND {}.index_date = m.index_date".format(name) if varying else "")
+            for name, varying in self.joins
+        )
+        columns = "".join(", {} AS {}".format(sql, _name(name)) for name, sql in self.columns.items())
+        ctes.append("cohort AS (SELECT p.patient_id, m.index_date{} FROM (SELECT DISTINCT patient_id FROM patients) p CROSS JOIN months m{})".format(columns, joins))
+
+        # Every key and count for each patient and month in the population, then one grouping set for the cube and one per measure
+        keys = [_age_group("({})".format(self.expression("age")))]
+        for key in self.keys[1:]:
+            value = self.expression(key)
+            keys.append("NULLIF({}, '')".format(value) if column_type(self.study.variables[key]) == "category" else value)
+        selected = ", ".join("{} AS {}".format(sql, _name(key)) for sql, key in zip(keys, self.keys))
+        counts = "".join(", {} AS {}".format(self.expression(count), _name(count)) for count in self.counts)
+        ctes.append("population AS (SELECT c.patient_id, strftime(c.index_date, '%Y-%m-%d') AS date, {}{} FROM cohort c WHERE {})".format(
+            selected, counts, self.condition(("name", "population"))))
+        # Measures grouped by the same keys (in any order) share one grouping set
+        sets = {self.grouping(keys): keys for keys in reversed(self.sets)}
+        sets = ", ".join("({})".format(", ".join(["date"] + [_name(k) for k in keys])) for keys in sets.values())
+        return "WITH {}\nSELECT grouping({keys}) AS _set, date, {keys}, {sums}, count(*) AS population, min(patient_id) AS _first FROM population GROUP BY GROUPING SETS ({sets}) ORDER BY _set, date, _first".format(
+            ",\n".join(ctes),
+            keys=", ".join(_name(k) for k in self.keys),
+            sums=", ".join("sum({0}) AS {0}".format(_name(c)) for c in self.counts),
+            sets=sets,
+        )
+
+    def grouping(self, keys):
+        """The grouping() value of the rows grouped by keys (a bit for each key left out, first key highest)."""
+        return sum(1 << (len(self.keys) - 1 - i) for i, key in enumerate(self.keys) if key not in keys)
+
+    # e. Results #
+
+    def cubes(self, result):
+        """(date, cube) for each index date, in cube.py's layout (rows in order of their first patient, as longitudinal.py)."""
+        rows = result[result["_set"] == self.grouping(self.sets[0])]
+        cube = rows[DIMENSIONS + counts_for(self.study)].copy()
+        cube["pop"] = rows["population"]
+        for date in self.index_dates:
+            yield date, cube[cube["date"] == date].reset_index(drop=True)
+
+    def stacked(self, result):
+        """Every measure stacked as measures.derive gives it (id, group_by keys, numerator, denominator, date, value)."""
+        import pandas as pd
+
+        stacked = []
+        for measure in self.measures:
+            keys = [k for k in measure["group_by"] if k != "population"]
+            rows = result[result["_set"] == self.grouping(keys)]
+            table = rows[keys + ["date", measure["numerator"], measure["denominator"]]].rename(columns={measure["numerator"]: "numerator", measure["denominator"]: "denominator"})
+            table.insert(0, "id", measure["id"])
+            stacked.append(table)
+        stacked = pd.concat(stacked, ignore_index=True)
+        stacked["value"] = stacked["numerator"] / stacked["denominator"]
+        return stacked
+
+
+def _returning_count(returning):
+    if returning == "binary_flag":
+        return "1"
+    if returning == "number_of_matches_in_period":
+        return "count(*)"
+    raise NotImplementedError("returning={!r} is not supported by the DuckDB backend".format(returning))
+
+
+def _age_group(age):
+    # As cube.age_group: cut(age, breaks = AGE_BREAKS, include.lowest = TRUE)
+    bands = " ".join("WHEN {} <= {} THEN {}".format(age, high, _quote(label)) for high, label in zip(AGE_BREAKS[1:], AGE_GROUPS))
+    return "CASE WHEN {0} < {1} THEN NULL {2} END".format(age, AGE_BREAKS[0], bands)
+
+
+### 3. Run ###
+
+
+def run(connection, plan, profile=None):
+    """Run the plan, returning the grouped rows as a DataFrame (with DuckDB's query profile saved to profile, if given)."""
+    if profile:
+        connection.execute("PRAGMA enable_profiling = 'json'")
+        connection.execute("PRAGMA profiling_output = {}".format(_quote(profile)))
+    try:
+        result = connection.execute(plan.sql()).df()
+    finally:
+        if profile:
+            connection.execute("PRAGMA disable_profiling")
+    for column in plan.counts + ["population"]:
+        result[column] = result[column].fillna(0).astype("int64")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the study definition against a local DuckDB database of EHR tables")
+    parser.add_argument("--tables-dir", required=True, help="Directory of EHR tables (see ehr_tables.py and synthetic_ehr.py)")
+    parser.add_argument("--database", default=":memory:", help="DuckDB database file to keep the loaded tables in (default: in memory)")
+    parser.add_argument("--study-definition", default=STUDY_DEFINITION)
+    parser.add_argument("--start", help="First index date (default: the study index_date)")
+    parser.add_argument("--end", help="Last index date (default: the study end_date)")
+    parser.add_argument("--cube-dir", help="Write one cube_YYYY-MM-DD file per index date here")
+    parser.add_argument("--cube-format", default="csv.gz", choices=["csv", "csv.gz", "feather", "parquet"])
+    parser.add_argument("--measures-dir", help="Write one measure_<id>.csv per measure here")
+    parser.add_argument("--threads", type=int, help="DuckDB threads (default: all cores)")
+    parser.add_argument("--sql", help="Save the compiled SQL statement here")
+    parser.add_argument("--profile", help="Save DuckDB's query profile (JSON) here")
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    plan = Plan(study, study.index_dates(args.start, args.end))
+    if args.sql:
+        with open(args.sql, "w") as f:
+            f.write(plan.sql() + "\n")
+    result = run(connect(args.tables_dir, args.database, args.threads), plan, args.profile)
+
+    if args.cube_dir:
+        os.makedirs(args.cube_dir, exist_ok=True)
+        for date, cube in plan.cubes(result):
+            write_cube(cube, cube_path(args.cube_dir, date, args.cube_format))
+    if args.measures_dir:
+        stacked = suppress(plan.stacked(result), [m["id"] for m in plan.measures if m["small_number_suppression"]])
+        write_measures(stacked, plan.measures, args.measures_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#######################################
+### Generate dummy data at scale ###
+#######################################
+
+# Purpose: To generate large dummy versions of the monthly cohort files (input_YYYY-MM-DD), so that every stage after extraction can be load-tested locally at a realistic size. The cohortextractor dummy data (population_size in project.yaml) is far too small to show how anything scales. Values follow the return_expectations in the study definition:
+# - "int": {"distribution": "population_ages"} - ages following the England population (5-year bands, uniform within each band)
+# - "int": {"distribution": "normal", ...} - counts rounded to whole numbers and at least zero
+# - "category": {"ratios": ...} - categories in those proportions
+# - "incidence" - the proportion with a value (a True flag, a category or a non-zero count); "rate": "universal" means everyone has one
+
+# The same patients are followed through every month. Variables that do not depend on the index date (sex, region, ethnicity etc. in this study) keep the same values each month, and the others (admissions, GP consultations) are drawn afresh. Patients are generated in chunks from a seed for each chunk and month, so memory depends on the chunk size rather than the number of patients, months are written in parallel, and the same arguments always give the same files.
+
+# Example: python analysis/dummy_data.py --patients 10000000 --output-dir output/dummy --format feather
+
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from cohort_io import FORMATS, CohortWriter, column_type
+from definition import load_study
+
+
+# Proportion of the England population in each 5-year age band from 0-4 to 90+ (ONS mid-year estimates, to one decimal place)
+POPULATION_AGES = [5.7, 6.1, 5.9, 5.5, 6.1, 6.7, 6.8, 6.6, 6.2, 6.6, 6.9, 6.6, 5.8, 5.0, 5.0, 3.6, 2.6, 1.6, 0.9]
+OLDEST = 104  # Ages in the 90+ band are spread evenly up to here
+
+# Seed stream for the variables that do not change between months
+STATIC = 0
+
+
+### 1. Values from return_expectations ###
+
+
+def population_ages(rng, size):
+    probabilities = np.array(POPULATION_AGES) / sum(POPULATION_AGES)
+    band = rng.choice(len(probabilities), size=size, p=probabilities)
+    width = np.where(band == len(probabilities) - 1, OLDEST - 90 + 1, 5)
+    return (band * 5 + np.floor(rng.random(size) * width)).astype(np.uint8)
+
+
+def generate(variable, size, rng, defaults):
+    """Random values for one variable, following its return_expectations (or the study's default_expectations)."""
+    expectations = dict(defaults, **variable.return_expectations)
+    incidence = 1.0 if expectations.get("rate") == "universal" else expectations.get("incidence", 1.0)
+    present = rng.random(size) < incidence
+    dtype = column_type(variable)
+
+    if dtype == "bool":
+        return present
+    if dtype == "category":
+        ratios = expectations["category"]["ratios"]
+        categories = sorted(ratios)
+        probabilities = np.array([ratios[c] for c in categories], dtype=float)
+        codes = np.searchsorted(np.cumsum(probabilities / probabilities.sum()), rng.random(size), side="right")
+        codes = np.where(present, np.minimum(codes, len(categories) - 1), -1)
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+    distribution = expectations.get("int", {})
+    if distribution.get("distribution") == "population_ages":
+        values = population_ages(rng, size)
+    elif distribution.get("distribution") == "normal":
+        values = np.round(rng.normal(distribution["mean"], distribution["stddev"], size)).clip(0, np.iinfo(dtype).max)
+    else:
+        raise ValueError("{}: no dummy data for int expectations {}".format(variable.name, distribution))
+    return np.where(present, values, 0).astype(dtype)
+
+
+### 2. Patients and months ###
+
+
+def varying(study):
+    """Names of output variables whose values depend on the index date."""
+    return {variable.name for variable in study.output_variables if variable.uses_index_date()}
+
+
+def chunk_rng(seed, chunk, month):
+    return np.random.default_rng(np.random.SeedSequence([seed, chunk, month]))
+
+
+def generate_chunk(study, first_id, size, seed, chunk, month):
+    """One chunk of patients for one month (month counts from 1; static values come from the same stream every month)."""
+    changing = varying(study)
+    static_rng, month_rng = chunk_rng(seed, chunk, STATIC), chunk_rng(seed, chunk, month)
+    cohort = pd.DataFrame({"patient_id": np.arange(first_id, first_id + size, dtype=np.int64)})
+    for variable in study.output_variables:
+        rng = month_rng if variable.name in changing else static_rng
+        cohort[variable.name] = generate(variable, size, rng, study.default_expectations)
+    return cohort
+
+
+def write_month(month, index_date, study, patients, chunksize, seed, directory, fmt):
+    path = os.path.join(directory, "input_{}.{}".format(index_date, fmt))
+    with CohortWriter(path, study) as writer:
+        for chunk, first in enumerate(range(0, patients, chunksize)):
+            writer.write(generate_chunk(study, first + 1, min(chunksize, patients - first), seed, chunk, month))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate large dummy monthly cohort files from the study definition's return_expectations")
+    parser.add_argument("--patients", type=int, default=1000000)
+    parser.add_argument("--output-dir", default="output/dummy")
+    parser.add_argument("--format", default="feather", choices=FORMATS)
+    parser.add_argument("--study-definition", default="analysis/study_definition.py")
+    parser.add_argument("--start", help="First index date (default: the study index_date)")
+    parser.add_argument("--end", help="Last index date (default: the study end_date)")
+    parser.add_argument("--seed", type=int, default=2022)
+    parser.add_argument("--chunksize", type=int, default=1000000, help="Patients generated at a time (this, with the seed, determines the values)")
+    parser.add_argument("--workers", type=int, default=None, help="Months written in parallel (default: all cores)")
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    os.makedirs(args.output_dir, exist_ok=True)
+    dates = study.index_dates(args.start, args.end)
+    write = partial(write_month, study=study, patients=args.patients, chunksize=args.chunksize, seed=args.seed, directory=args.output_dir, fmt=args.format)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for path in pool.map(write, range(1, len(dates) + 1), dates):
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
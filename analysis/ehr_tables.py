@@ -0,0 +1,74 @@
+#######################################
+### Local EHR tables ###
+#######################################
+
+# Purpose: To describe and load the patient record tables used by the local extraction tools. These stand in for the OpenSAFELY backend tables that the study definition queries (registrations, addresses, coded events, GP consultations, APCS admissions, SUS ethnicity and deaths), so that extraction can be run and profiled outside the secure environment.
+
+
+import hashlib
+import os
+
+import pandas as pd
+
+
+# Columns for each table (one row per record, linked by patient_id)
+TABLES = {
+    "patients": ["patient_id", "sex", "date_of_birth", "date_of_death"],
+    "registrations": ["patient_id", "start_date", "end_date", "region"],
+    "addresses": ["patient_id", "start_date", "end_date", "index_of_multiple_deprivation", "rural_urban_classification"],
+    "clinical_events": ["patient_id", "date", "ctv3_code"],
+    "gp_consultations": ["patient_id", "date"],
+    "apcs": ["patient_id", "admission_date", "admission_method", "primary_diagnosis"],
+    "sus_ethnicity": ["patient_id", "group_6"],
+}
+
+DATE_COLUMNS = {"date_of_birth", "date_of_death", "start_date", "end_date", "date", "admission_date"}
+
+# Columns holding codes or categories, which must stay as text (e.g. admission method "21", ethnicity "1")
+TEXT_COLUMNS = {"sex", "region", "rural_urban_classification", "ctv3_code", "admission_method", "primary_diagnosis", "group_6"}
+
+EXTENSIONS = (".parquet", ".feather", ".csv.gz", ".csv")
+
+
+def table_path(directory, name):
+    for extension in EXTENSIONS:
+        path = os.path.join(directory, name + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError("No {} table in {}".format(name, directory))
+
+
+def read_table(directory, name, patient_ids=None):
+    """Read one table, or only the rows for patient_ids (e.g. a sample) if given."""
+    path = table_path(directory, name)
+    if path.endswith(".parquet"):
+        # Parquet can skip row groups without any of the patients while reading
+        filters = None if patient_ids is None else [("patient_id", "in", list(patient_ids))]
+        table = pd.read_parquet(path, columns=TABLES[name], filters=filters)
+    elif path.endswith(".feather"):
+        table = pd.read_feather(path, columns=TABLES[name])
+    else:
+        table = pd.read_csv(path, usecols=TABLES[name], dtype={c: str for c in TEXT_COLUMNS})
+    if patient_ids is not None:
+        table = table[table["patient_id"].isin(patient_ids)].reset_index(drop=True)
+    for column in TABLES[name]:
+        if column in DATE_COLUMNS:
+            table[column] = pd.to_datetime(table[column]).values.astype("datetime64[D]")
+        elif column in TEXT_COLUMNS:
+            table[column] = table[column].fillna("").astype(str).astype(object)
+    return table
+
+
+def load_tables(directory, patient_ids=None):
+    """Read every table once into memory (only the rows for patient_ids, if given)."""
+    return {name: read_table(directory, name, patient_ids) for name in TABLES}
+
+
+def tables_version(directory):
+    """A fingerprint of the table files (name, size and modification time), which changes whenever the data does."""
+    digest = hashlib.sha256()
+    for name in sorted(TABLES):
+        path = table_path(directory, name)
+        status = os.stat(path)
+        digest.update("{}|{}|{}\n".format(os.path.basename(path), status.st_size, status.st_mtime_ns).encode())
+    return digest.hexdigest()
@@ -0,0 +1,164 @@
+#######################################
+### Windowed event counts and as-of states ###
+#######################################
+
+# Purpose: To count each patient's events in a date window (e.g. GP consultations or admissions between index_date and last_day_of_month(index_date)), and to look up each patient's state as of a date (see StateIndex below), without rescanning every row for every index date. The events are sorted once by date, so that the events in any window are a contiguous run of the sorted events, found with two binary searches over the dates. Each patient's count is then a bincount of just that run, and the counts for a subset of the events (e.g. those matching one codelist) are a bincount of the run's events in the subset.
+
+# Building the index is O(events log events), once. Each index date is then O(log events) to find its window plus O(events in the window) to count them, rather than O(events) for a scan; for monthly windows over 40 months that is about a fortieth of the work.
+
+# Sorting by patient first and searching for each patient's window was tried, but that costs O(patients log events) for every index date, which was slower than scanning with around ten events per patient.
+
+
+import numpy as np
+import pandas as pd
+
+
+class EventIndex:
+    """Events (a patient position and a date each) indexed for counting per patient in any date window.
+
+    subsets are optional boolean masks over the events (name -> mask), which can be counted on their own.
+    """
+
+    def __init__(self, positions, dates, size, subsets=None):
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        known = ~np.isnat(dates)
+        positions, dates = np.asarray(positions)[known], dates[known]
+        order = np.argsort(dates, kind="stable")
+        self.positions = positions[order]
+        self.dates = dates[order]
+        self.size = size
+        self.subsets = {name: np.asarray(subset)[known][order] for name, subset in (subsets or {}).items()}
+        self._rolling = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def bounds(self, start=None, end=None):
+        """The first and one past the last sorted event between start and end (inclusive; None is open)."""
+        lo = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, "D"), side="left")
+        hi = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, "D"), side="right")
+        return lo, max(hi, lo)  # An empty window (start after end) counts nothing
+
+    def count(self, start=None, end=None, subset=None, bounds=None):
+        """Events per patient between start and end, optionally only those in a subset (pass bounds to reuse them)."""
+        lo, hi = bounds if bounds is not None else self.bounds(start, end)
+        positions = self.positions[lo:hi]
+        if subset is not None:
+            positions = positions[self.subsets[subset][lo:hi]]
+        return np.bincount(positions, minlength=self.size)
+
+    def rolling(self, subset=None):
+        """The RollingCounts of these events (or a subset), kept so that each window is slid on from the last one counted."""
+        if subset not in self._rolling:
+            self._rolling[subset] = RollingCounts(self, subset)
+        return self._rolling[subset]
+
+
+# Rolling windows (e.g. 28 days, moved on a week at a time) overlap, so counting each window afresh counts most events several times over. A window slid forward from the last one instead only adds the events that have entered it and takes away those that have left: the sorted events entering are those between the old and new end, and those leaving between the old and new start, so over a whole series each event is added once and removed once, whatever the window length or step.
+
+
+class RollingCounts:
+    """Events per patient (optionally only a subset) in a window slid forward through an EventIndex.
+
+    Windows can be asked for in any order; one that is behind the last, or too far ahead of it to overlap, is counted afresh.
+    """
+
+    def __init__(self, events, subset=None):
+        self.events = events
+        self.subset = subset
+        self.lo = self.hi = 0
+        self.counts = np.zeros(events.size, dtype=np.int64)
+
+    def count(self, start=None, end=None, bounds=None):
+        """Events per patient between start and end (pass bounds to reuse them)."""
+        lo, hi = bounds if bounds is not None else self.events.bounds(start, end)
+        if lo < self.lo or hi < self.hi or lo > self.hi or (lo - self.lo) + (hi - self.hi) > hi - lo:
+            # Moving back, or so far on that recounting the window is less work
+            self.counts = self.events.count(subset=self.subset, bounds=(lo, hi))
+        else:
+            self._add(self.hi, hi, 1)
+            self._add(self.lo, lo, -1)
+        self.lo, self.hi = lo, hi
+        return self.counts.copy()  # The counts are updated in place by the next window
+
+    def _add(self, lo, hi, change):
+        positions = self.events.positions[lo:hi]
+        if self.subset is not None:
+            positions = positions[self.events.subsets[self.subset][lo:hi]]
+        np.add.at(self.counts, positions, change)
+
+
+# Patient states as of a date (registered, an address, the last ethnicity code, ...) are held as change points rather than windows: for each patient, the days on which the row in force changes, sorted by patient and day. Every patient's state as of any date is then one binary search over the change points, only for the patients with any rows, and the queries are sorted so the searches run close to a single pass. Building them is O(rows log rows), once, and overlapping periods are resolved while building, so a lookup never looks at the rows again.
+
+
+class StateIndex:
+    """Rows (a patient position and a start date each, and optionally an end date) indexed by the row in force for each patient on any date.
+
+    A row is in force from its start date to its end date inclusive (for ever if it has no end date, or ends is None). Where several rows are in force, the last one in the given order wins, as for registrations sorted by start date.
+    """
+
+    def __init__(self, positions, starts, size, ends=None):
+        starts = np.asarray(starts, dtype="datetime64[D]")
+        rows = np.flatnonzero(~np.isnat(starts))  # A row without a start date is never in force
+        positions, starts = np.asarray(positions)[rows].astype(np.int64), starts[rows].astype(np.int64)
+        if ends is None:
+            positions, days, self.rows = _open_changes(positions, starts, rows)
+        else:
+            positions, days, self.rows = _period_changes(positions, starts, np.asarray(ends, dtype="datetime64[D]")[rows], rows)
+        self.size = size
+        # Days are offset so that 0 is before every change point (the patient's state before any row)
+        self.origin = days.min() - 1 if len(days) else 0
+        self.span = days.max() - self.origin + 1 if len(days) else 1
+        self.keys = positions * self.span + (days - self.origin)
+        self.patients = np.unique(positions)
+        self._starts = self.patients * self.span
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows_as_of(self, date=None):
+        """For every patient, the index of the row in force on the date (-1 if none); None is after every row has started."""
+        day = self.span - 1 if date is None else np.clip(np.datetime64(date, "D").astype(np.int64) - self.origin, 0, self.span - 1)
+        last = np.searchsorted(self.keys, self._starts + day, side="right") - 1
+        # The last change point on or before the date must be the patient's own, not the previous patient's
+        own = (last >= 0) & (self.keys[np.maximum(last, 0)] >= self._starts) if len(self.keys) else np.zeros(len(self.patients), dtype=bool)
+        result = np.full(self.size, -1, dtype=np.int64)
+        result[self.patients[own]] = self.rows[last[own]]
+        return result
+
+    def as_of(self, date, values, default):
+        """For every patient, the value (from values, aligned to the rows) of the row in force on the date, or default."""
+        rows = self.rows_as_of(date)
+        values = np.asarray(values)
+        result = np.full(self.size, default, dtype=values.dtype if values.dtype != object else object)
+        result[rows >= 0] = values[rows[rows >= 0]]
+        return result
+
+
+def _open_changes(positions, starts, rows):
+    # Rows without end dates: each start is a change point, to the last row (in order) started by then
+    if not len(rows):
+        return positions, starts, rows
+    order = np.lexsort((rows, starts, positions))
+    positions, days, rows = positions[order], starts[order], rows[order]
+    # A running maximum of the row within each patient (patients are offset so earlier patients never win)
+    offset = positions * (rows.max() + 1)
+    rows = np.maximum.accumulate(offset + rows) - offset
+    last = np.append((positions[1:] != positions[:-1]) | (days[1:] != days[:-1]), True)
+    return positions[last], days[last], rows[last]
+
+
+def _period_changes(positions, starts, ends, rows):
+    # Rows with periods: the state can change where any period starts or the day after one ends
+    open_ended = np.isnat(ends)
+    ends = np.where(open_ended, np.iinfo(np.int64).max, ends.astype(np.int64))
+    changes = pd.DataFrame({
+        "position": np.concatenate([positions, positions[~open_ended]]),
+        "day": np.concatenate([starts, ends[~open_ended] + 1]),
+    }).drop_duplicates()
+    periods = pd.DataFrame({"position": positions, "start": starts, "end": ends, "row": rows})
+    # Each change point against each of its patient's periods (a handful per patient), keeping the last period in force
+    pairs = changes.merge(periods, on="position")
+    pairs["row"] = np.where((pairs["start"] <= pairs["day"]) & (pairs["day"] <= pairs["end"]), pairs["row"], -1)
+    changes = pairs.groupby(["position", "day"], sort=True)["row"].max().reset_index()
+    return changes["position"].to_numpy(), changes["day"].to_numpy(), changes["row"].to_numpy()
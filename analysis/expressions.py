@@ -0,0 +1,295 @@
+#######################################
+### Evaluate cohortextractor expressions ###
+#######################################
+
+# Purpose: To evaluate the expression strings used by patients.satisfying and patients.categorised_as (e.g. "registered AND NOT has_died AND age <= 120") over whole columns at once, compiling each one only once. The grammar follows cohortextractor: AND / OR / NOT, comparisons (= != < <= > >=), + - * /, numbers, 'strings', variable names and brackets. A bare variable is true when it is non-zero / non-empty.
+
+
+import functools
+import re
+
+import numpy as np
+import pandas as pd
+
+
+TOKEN = re.compile(r"\s*(?:(\d+\.?\d*)|('[^']*'|\"[^\"]*\")|(<=|>=|!=|=|<|>|\+|-|\*|/|\(|\))|([A-Za-z_][A-Za-z0-9_]*))")
+KEYWORDS = {"AND", "OR", "NOT"}
+
+
+### 1. Parse ###
+
+
+def tokenise(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match or match.end() == position:
+            raise ValueError("Cannot parse expression at {!r}".format(expression[position:]))
+        number, string, operator, name = match.groups()
+        if number is not None:
+            tokens.append(("number", float(number) if "." in number else int(number)))
+        elif string is not None:
+            tokens.append(("string", string[1:-1]))
+        elif operator is not None:
+            tokens.append(("op", operator))
+        elif name.upper() in KEYWORDS:
+            tokens.append(("op", name.upper()))
+        else:
+            tokens.append(("name", name))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    # Recursive descent parser producing nested tuples, e.g. ("AND", left, right)
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenise(expression)
+        self.position = 0
+
+    def parse(self):
+        tree = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError("Unexpected {!r} in {!r}".format(self.tokens[self.position][1], self.expression))
+        return tree
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _accept(self, *operators):
+        kind, value = self._peek()
+        if kind == "op" and value in operators:
+            self.position += 1
+            return value
+        return None
+
+    def _binary(self, operand, *operators):
+        tree = operand()
+        operator = self._accept(*operators)
+        while operator:
+            tree = (operator, tree, operand())
+            operator = self._accept(*operators)
+        return tree
+
+    def _or(self):
+        return self._binary(self._and, "OR")
+
+    def _and(self):
+        return self._binary(self._not, "AND")
+
+    def _not(self):
+        if self._accept("NOT"):
+            return ("NOT", self._not())
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._sum()
+        operator = self._accept("=", "!=", "<", "<=", ">", ">=")
+        return (operator, left, self._sum()) if operator else left
+
+    def _sum(self):
+        return self._binary(self._product, "+", "-")
+
+    def _product(self):
+        return self._binary(self._atom, "*", "/")
+
+    def _atom(self):
+        if self._accept("("):
+            tree = self._or()
+            if not self._accept(")"):
+                raise ValueError("Missing ) in {!r}".format(self.expression))
+            return tree
+        if self._accept("-"):
+            return ("-", ("number", 0), self._atom())
+        kind, value = self._peek()
+        if kind not in ("number", "string", "name"):
+            raise ValueError("Unexpected {!r} in {!r}".format(value, self.expression))
+        self.position += 1
+        return (kind, value)
+
+
+def parse(expression):
+    return _Parser(expression).parse()
+
+
+def names(expression):
+    """Variable names referenced by an expression."""
+    return [value for kind, value in tokenise(expression) if kind == "name"]
+
+
+### 2. Compile ###
+
+# Each expression is parsed once into a tree of small functions over whole columns (with constant parts such as 32844*1/5 worked out in advance), so nothing is interpreted per row or per index date. Two common shapes of categorised_as are recognised and replaced by a single lookup:
+# - a ladder of ranges on one variable ("x >= a AND x < b" for each category, e.g. imd_quintile) becomes one binned search
+# - a fallback between two variables ("a='1' OR (NOT a AND b='1')" for each category, e.g. ethnicity) becomes one coalesce and one mapping
+
+COMPARISONS = {
+    "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal,
+    "+": np.add, "-": np.subtract, "*": np.multiply, "/": np.true_divide,
+}
+
+
+def _fold(tree):
+    # Work out arithmetic on constants in advance
+    kind = tree[0]
+    if kind in ("number", "string", "name"):
+        return tree
+    if kind == "NOT":
+        return ("NOT", _fold(tree[1]))
+    left, right = _fold(tree[1]), _fold(tree[2])
+    if kind in ("+", "-", "*", "/") and left[0] == "number" and right[0] == "number":
+        return ("number", COMPARISONS[kind](left[1], right[1]).item())
+    return (kind, left, right)
+
+
+def _kernel(tree):
+    # A function of the columns for one node of the tree
+    kind = tree[0]
+    if kind in ("number", "string"):
+        value = tree[1]
+        return lambda columns: value
+    if kind == "name":
+        name = tree[1]
+        return lambda columns: columns[name]
+    if kind == "NOT":
+        operand = _kernel(tree[1])
+        return lambda columns: ~_truthy(operand(columns))
+    left, right = _kernel(tree[1]), _kernel(tree[2])
+    if kind == "AND":
+        return lambda columns: _truthy(left(columns)) & _truthy(right(columns))
+    if kind == "OR":
+        return lambda columns: _truthy(left(columns)) | _truthy(right(columns))
+    if kind == "=":
+        return lambda columns: np.asarray(left(columns) == right(columns))
+    if kind == "!=":
+        return lambda columns: np.asarray(left(columns) != right(columns))
+    operator = COMPARISONS[kind]
+    return lambda columns: operator(left(columns), right(columns))
+
+
+def _condition(tree):
+    kernel = _kernel(tree)
+    return lambda columns: _truthy(kernel(columns))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_expression(expression):
+    """A function mapping name -> numpy array columns to the boolean result of an expression."""
+    return _condition(_fold(parse(expression)))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_categories(categories):
+    """A function (columns, size) -> category array for a categorised_as mapping, given as a tuple of (category, expression) pairs."""
+    default = next((k for k, v in categories if v.strip() == "DEFAULT"), "")
+    rules = [(k, _fold(parse(v))) for k, v in categories if v.strip() != "DEFAULT"]
+    return _ranges(rules, default) or _fallback(rules, default) or _first_match(rules, default)
+
+
+def _first_match(rules, default):
+    # General case: the first matching category wins
+    kernels = [(category, _condition(tree)) for category, tree in rules]
+
+    def categorise(columns, size):
+        result = np.full(size, default, dtype=object)
+        unassigned = np.ones(size, dtype=bool)
+        for category, kernel in kernels:
+            match = kernel(columns) & unassigned
+            result[match] = category
+            unassigned &= ~match
+        return result
+
+    return categorise
+
+
+def _range(tree):
+    # (name, low, high) for "name >= low AND name < high", otherwise None
+    if tree[0] != "AND":
+        return None
+    bounds = {}
+    for side in tree[1:]:
+        if side[0] not in (">=", "<") or side[1][0] != "name" or side[2][0] != "number":
+            return None
+        bounds[side[0]] = (side[1][1], side[2][1])
+    if set(bounds) != {">=", "<"} or bounds[">="][0] != bounds["<"][0]:
+        return None
+    return bounds[">="][0], bounds[">="][1], bounds["<"][1]
+
+
+def _ranges(rules, default):
+    ranges = [_range(tree) for _, tree in rules]
+    if not ranges or None in ranges or len({r[0] for r in ranges}) != 1:
+        return None
+    order = sorted(range(len(rules)), key=lambda i: ranges[i][1])
+    lows = np.array([ranges[i][1] for i in order], dtype=float)
+    highs = np.array([ranges[i][2] for i in order], dtype=float)
+    if np.any(lows >= highs) or np.any(highs[:-1] > lows[1:]):
+        return None  # Overlapping ranges depend on the order of the categories
+    labels = np.array([rules[i][0] for i in order] + [default], dtype=object)
+    name = ranges[0][0]
+
+    def categorise(columns, size):
+        values = np.asarray(columns[name], dtype=float)
+        bins = np.searchsorted(lows, values, side="right") - 1
+        inside = (bins >= 0) & (values < highs[np.maximum(bins, 0)])
+        return labels[np.where(inside, bins, len(labels) - 1)]
+
+    return categorise
+
+
+def _fallback_pair(tree):
+    # (first, second, value) for "first='v' OR (NOT first AND second='v')", otherwise None
+    if tree[0] != "OR" or tree[1][0] != "=" or tree[2][0] != "AND":
+        return None
+    first, value = tree[1][1], tree[1][2]
+    missing, second = tree[2][1], tree[2][2]
+    if first[0] != "name" or value[0] not in ("string", "number") or missing != ("NOT", first):
+        return None
+    if second[0] != "=" or second[1][0] != "name" or second[2] != value:
+        return None
+    return first[1], second[1][1], value[1]
+
+
+def _fallback(rules, default):
+    pairs = [_fallback_pair(tree) for _, tree in rules]
+    if not pairs or None in pairs or len({p[:2] for p in pairs}) != 1:
+        return None
+    first, second = pairs[0][:2]
+    mapping = {}
+    for (category, _), (_, _, value) in zip(rules, pairs):
+        mapping.setdefault(value, category)  # The first category for a value wins
+
+    def categorise(columns, size):
+        primary = np.asarray(columns[first])
+        values = np.where(_truthy(primary), primary, np.asarray(columns[second]))
+        # Look up each distinct value once
+        codes, distinct = pd.factorize(values)
+        labels = np.array([mapping.get(value, default) for value in distinct] + [default], dtype=object)
+        return labels[codes]
+
+    return categorise
+
+
+### 3. Evaluate ###
+
+
+def evaluate(expression, columns):
+    """Evaluate an expression string over a mapping of name -> numpy array, returning a boolean array."""
+    return compile_expression(expression)(columns)
+
+
+def _truthy(values):
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values
+    if values.dtype.kind in "OUS":
+        return values != ""
+    return values != 0
+
+
+def categorise(categories, columns, size):
+    """Evaluate a categorised_as mapping: the first matching category wins, otherwise DEFAULT."""
+    return compile_categories(tuple(categories.items()))(columns, size)
@@ -0,0 +1,568 @@
+#######################################
+### Longitudinal cohort extraction ###
+#######################################
+
+# Purpose: To extract the study population for every index date in a single pass over the patient records, rather than re-running the whole study definition once per month as `generate_cohort --index-date-range` does. Records are read and sorted once, date-independent filters (codelists, admission methods) are applied once, and variables that do not depend on the index date (e.g. sex, ethnicity_sus) are computed once and reused for every month. The output is one long-format table with a row per patient per month. With --cube-dir it instead writes one small aggregated cube per month (counts by date and every breakdown, see cube.py), which is all that standardisation and the measures need. Index dates are extracted in parallel by worker processes forked once everything date-independent has been prepared (see session.py).
+
+# For finer resolution than months, --step-days sets the index dates (e.g. weekly) and --window-days the window that admissions and GP consultations are counted over from each one (e.g. 28 days). Overlapping windows are slid forward from one index date to the next rather than counted afresh (see event_index.RollingCounts), so a weekly series of 28-day windows reads each event about as often as a monthly series does.
+
+# This runs against local copies of the EHR tables (see ehr_tables.py), not the OpenSAFELY backend.
+# Note: dates given in the study definition as the module-level `index_date` constant (rather than the string "index_date") are fixed dates, exactly as cohortextractor sees them.
+
+# Example: python analysis/longitudinal.py --tables-dir data/ehr --output output/longitudinal/cohort_long.parquet
+#          python analysis/longitudinal.py --tables-dir data/ehr --cube-dir output/cubes_weekly --step-days 7 --window-days 28
+
+
+import argparse
+import datetime
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import expressions
+from admissions import AdmissionsScan, group_admissions, scan_key
+from codelist_index import CACHE_DIR, load_index
+from cohort_io import output_format, write_cohort
+from column_cache import definition_keys
+from cube import INPUT_COLUMNS, counts_for, cube_path, write_cube
+from event_index import EventIndex, StateIndex
+from packed import Schema, population_variables
+
+
+### 1. Dates ###
+
+
+def resolve_date(value, index_date):
+    """Turn a study definition date ("index_date", "last_day_of_month(index_date)", "index_date + 27 days", "2019-01-01") into a numpy date."""
+    value = value.strip()
+    match = re.fullmatch(r"(.+?)\s*([+-])\s*(\d+)\s*(day|week|month|year)s?", value)
+    if match:
+        date = resolve_date(match.group(1), index_date)
+        amount = int(match.group(3)) * (1 if match.group(2) == "+" else -1)
+        unit = match.group(4)
+        if unit in ("day", "week"):
+            return date + amount * (7 if unit == "week" else 1)
+        # Months and years land on the same day of the month, or the last day of a shorter month
+        months = date.astype("datetime64[M]") + amount * (12 if unit == "year" else 1)
+        return np.minimum(months.astype("datetime64[D]") + (date - date.astype("datetime64[M]")), (months + 1).astype("datetime64[D]") - 1)
+    match = re.fullmatch(r"(first|last)_day_of_month\((.+)\)", value)
+    if match:
+        date = resolve_date(match.group(2), index_date).astype(datetime.date)
+        date = date.replace(day=1)
+        if match.group(1) == "last":
+            date = (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+        return np.datetime64(date, "D")
+    if value == "index_date":
+        return np.datetime64(index_date, "D")
+    if value == "today":
+        return np.datetime64(datetime.date.today(), "D")
+    return np.datetime64(datetime.date.fromisoformat(value), "D")
+
+
+def window(variable, index_date):
+    """The (start, end) dates a variable looks at; either end may be None (open)."""
+    if "between" in variable.kwargs:
+        start, end = variable.kwargs["between"]
+        return resolve_date(start, index_date), resolve_date(end, index_date)
+    start = variable.kwargs.get("on_or_after")
+    end = variable.kwargs.get("on_or_before")
+    return (
+        resolve_date(start, index_date) if start else None,
+        resolve_date(end, index_date) if end else None,
+    )
+
+
+# The month from the index date, which rolling windows replace
+MONTH_WINDOW = ["index_date", "last_day_of_month(index_date)"]
+
+
+def roll_windows(study, days):
+    """Make every variable that looks at the month from the index date (admitted_*, gp_count) look at the given number of days from it instead, returning their names."""
+    rolled = []
+    for variable in study.variables.values():
+        if variable.kwargs.get("between") == MONTH_WINDOW:
+            variable.kwargs["between"] = ["index_date", "index_date + {} days".format(days - 1)]
+            rolled.append(variable.name)
+    return rolled
+
+
+def _in_window(dates, start, end):
+    mask = ~np.isnat(dates)
+    if start is not None:
+        mask &= dates >= start
+    if end is not None:
+        mask &= dates <= end
+    return mask
+
+
+### 2. Extraction ###
+
+
+def dependencies(variable):
+    """Names of the other variables a variable needs (nested arguments and names in expressions)."""
+    names = [v.name for v in variable.nested]
+    if variable.function == "satisfying":
+        names += expressions.names(variable.arg(0, "expression"))
+    elif variable.function == "categorised_as":
+        for expression in variable.arg(0, "category_definitions").values():
+            names += [n for n in expressions.names(expression) if n != "DEFAULT"]
+    return list(dict.fromkeys(names))
+
+
+class Extraction:
+    """Evaluates every variable in a study definition against a set of EHR tables."""
+
+    def __init__(self, study, tables, cache_dir=CACHE_DIR, column_cache=None, tracer=None, rolling=False):
+        self.study = study
+        self.rolling = rolling
+        self.cache_dir = cache_dir
+        self.column_cache = column_cache
+        self.tracer = tracer
+        self.patient_ids = np.sort(tables["patients"]["patient_id"].unique())
+        self.size = len(self.patient_ids)
+
+        # Sort each table once by patient (and date), and record each row's position in patient_ids
+        self.tables = {}
+        for name, table in tables.items():
+            order = ["patient_id"] + [c for c in ("date", "admission_date", "start_date") if c in table.columns]
+            table = table.sort_values(order, kind="mergesort").reset_index(drop=True)
+            table["_position"] = np.searchsorted(self.patient_ids, table["patient_id"].to_numpy())
+            self.tables[name] = table
+
+        self._filters = {}
+        self._events = {}
+        self._states = {}
+        self._static = {}
+        self._admission_groups = group_admissions(study.variables.values())
+        self._admission_scans = {}
+        self._admission_results = {}
+        self._codelist_index = None
+        self._preparing = False
+        self.order = self._evaluation_order()
+        self.varying = self._find_varying()
+        self.definition_keys = definition_keys(self.order, self.dependencies)
+
+    # a. Dependencies #
+
+    def dependencies(self, variable):
+        return dependencies(variable)
+
+    def _evaluation_order(self):
+        # Variables can refer to ones defined later (population uses age), so order them by dependency
+        order = []
+
+        def visit(name, seen=()):
+            if name in order:
+                return
+            if name in seen:
+                raise ValueError("Circular reference to {}".format(name))
+            for dependency in self.dependencies(self.study.variables[name]):
+                visit(dependency, seen + (name,))
+            order.append(name)
+
+        for name in self.study.variables:
+            visit(name)
+        return [self.study.variables[name] for name in order]
+
+    def _find_varying(self):
+        varying = set()
+        for variable in self.order:
+            if variable.uses_index_date() or any(n in varying for n in self.dependencies(variable)):
+                varying.add(variable.name)
+        return varying
+
+    # b. Evaluation #
+
+    def evaluate(self, index_date, names=None):
+        """Return name -> array (aligned to patient_ids) for the population and the named variables (default: every output variable) at one index date.
+
+        Columns are computed on demand, so an intermediate is only evaluated if something that needs it is not already cached.
+        """
+        columns = _Columns(self, index_date)
+        self._admission_results = {}
+        for name in ["population"] + (names or [v.name for v in self.study.output_variables]):
+            columns[name]
+        return columns
+
+    def _column(self, variable, index_date, columns):
+        # Variables that do not depend on the index date are computed once; with a column cache, anything unchanged since the last run is read back
+        name = variable.name
+        if name not in self.varying and name in self._static:
+            return self._static[name]
+        key = None
+        if self.column_cache is not None:
+            key = self.column_cache.key(self.definition_keys[name], index_date if name in self.varying else None)
+            values = self.column_cache.get(key)
+        if key is None or values is None:
+            # Evaluate what it needs first, so that each variable is timed on its own when tracing
+            for dependency in self.dependencies(variable):
+                columns[dependency]
+            values = self._evaluate(variable, index_date, columns) if self.tracer is None else self._traced(variable, index_date, columns)
+            if key is not None:
+                self.column_cache.put(key, values)
+        if name not in self.varying:
+            self._static[name] = values
+        return values
+
+    def _evaluate(self, variable, index_date, columns):
+        try:
+            evaluator = EVALUATORS[variable.function]
+        except KeyError:
+            raise NotImplementedError("patients.{} is not supported locally".format(variable.function))
+        return evaluator(self, variable, np.datetime64(index_date, "D"), columns)
+
+    def _traced(self, variable, index_date, columns):
+        # Date-independent variables are evaluated once, so they are recorded once as "static"; the first evaluation of the others in prepare() also builds the indexes and scans they share with later index dates, so it is recorded as "prepare"
+        if variable.name not in self.varying:
+            label = "static"
+        else:
+            label = "prepare" if self._preparing else str(index_date)
+        with self.tracer.measure(index_date=label, variable=variable.name, function=variable.function) as record:
+            values = self._evaluate(variable, index_date, columns)
+        # Rows read: the whole source table (every admissions variable is counted as reading the scan it shares with its group), or one per patient for expressions
+        table = SOURCE_TABLES.get(variable.function)
+        record["rows"] = len(self.tables[table]) if table else (self.size if variable.function in ("satisfying", "categorised_as") else 0)
+        record["result_bytes"] = np.asarray(values).nbytes
+        return values
+
+    def filter(self, variable, table, build, kind="matches"):
+        """Cache a date-independent row filter for a variable, e.g. codelist or admission method matches (or another kind of per-row values, e.g. categories)."""
+        key = (variable.name, kind)
+        if key not in self._filters:
+            self._filters[key] = build(self.tables[table])
+        return self._filters[key]
+
+    def events(self, key, table, date_column, matches=None):
+        """An EventIndex (see event_index.py) over a table's rows, or only those matching, built once and shared by every index date."""
+        if key not in self._events:
+            rows = self.tables[table]
+            if matches is not None:
+                rows = rows[matches]
+            self._events[key] = EventIndex(rows["_position"].to_numpy(), rows[date_column].to_numpy(dtype="datetime64[D]"), self.size)
+        return self._events[key]
+
+    def states(self, key, table, start_column, end_column=None, matches=None):
+        """A StateIndex (see event_index.py) of the row in force per patient over a table's rows, or only those matching, built once and shared by every index date."""
+        if key not in self._states:
+            rows = self.tables[table]
+            if matches is not None:
+                rows = rows[matches]
+            ends = rows[end_column].to_numpy(dtype="datetime64[D]") if end_column else None
+            self._states[key] = StateIndex(rows["_position"].to_numpy(), rows[start_column].to_numpy(dtype="datetime64[D]"), self.size, ends)
+        return self._states[key]
+
+    def count(self, events, start, end):
+        """Events per patient between start and end; with rolling windows, slid on from the last window (see RollingCounts)."""
+        if self.rolling:
+            return events.rolling().count(start, end)
+        return events.count(start, end)
+
+    @property
+    def codelist_index(self):
+        """The compiled prefix index over every ICD-10 codelist in the study (loaded from the cache if unchanged)."""
+        if self._codelist_index is None:
+            icd10 = [c for c in self.study.codelists.values() if c.system == "icd10"]
+            self._codelist_index = load_index(icd10, self.cache_dir)
+        return self._codelist_index
+
+    def admissions(self, variable, index_date):
+        """Evaluate an admitted_to_hospital variable, sharing one APCS scan with every variable in its group."""
+        key = scan_key(variable)
+        if key not in self._admission_scans:
+            self._admission_scans[key] = AdmissionsScan(self._admission_groups[key], self.tables["apcs"], self.codelist_index, self.size)
+        if key not in self._admission_results:
+            start, end = window(variable, index_date)
+            self._admission_results[key] = self._admission_scans[key].evaluate(start, end, self.rolling)
+        return self._admission_results[key][variable.name]
+
+    def prepare(self, index_date=None):
+        """Build everything that does not depend on the index date (codelist index, row filters, admissions scans and date-independent variables) by evaluating one index date.
+
+        When tracing, this evaluation is recorded too (see _traced), so one-off work shows up in the trace.
+        """
+        self._preparing = True
+        try:
+            self.evaluate(index_date or self.study.index_dates()[0])
+        finally:
+            self._preparing = False
+        return self
+
+    def month(self, index_date):
+        """The population at one index date: a row per patient with every output variable."""
+        columns = self.evaluate(index_date)
+        population = columns["population"].astype(bool)
+        month = pd.DataFrame({"patient_id": self.patient_ids[population]})
+        month["date"] = str(index_date)
+        for variable in self.study.output_variables:
+            month[variable.name] = columns[variable.name][population]
+        return month
+
+    def run(self, index_dates):
+        """Evaluate every index date and return one long-format DataFrame (patient x month)."""
+        return pd.concat([self.month(index_date) for index_date in index_dates], ignore_index=True)
+
+    def cube_schema(self):
+        """The packed layout of the variables a cube needs (see cube.py and packed.py)."""
+        return Schema(self.study, population_variables(self.study) + INPUT_COLUMNS + counts_for(self.study))
+
+    def cube(self, index_date, schema):
+        """The cube for one index date.
+
+        The month is packed (see packed.py) and counted from the packed columns, so no patient-level DataFrame is built.
+        """
+        month = self.pack(index_date, schema)
+        return month.aggregate(str(index_date), counts_for(self.study), where=month.population(self.study))
+
+    def cubes(self, index_dates):
+        """Yield (index date, cube) for each index date, evaluating only the variables a cube needs."""
+        schema = self.cube_schema()
+        for index_date in index_dates:
+            yield index_date, self.cube(index_date, schema)
+
+    def pack(self, index_date, schema):
+        """Every patient at one index date, packed to the schema's variables (see packed.py)."""
+        return schema.pack(self.evaluate(index_date, schema.names), static=[name for name in schema.names if name not in self.varying])
+
+    # c. Shared helpers for evaluators #
+
+    def last_value(self, positions, values, default):
+        """The last value per patient from rows already sorted by patient and date."""
+        result = np.full(self.size, default, dtype=object if isinstance(default, str) else type(default))
+        if len(positions):
+            last = np.append(positions[1:] != positions[:-1], True)
+            result[positions[last]] = values[last]
+        return result
+
+
+class _Columns(dict):
+    # Variable name -> values at one index date, evaluating each variable the first time it is looked up
+
+    def __init__(self, extraction, index_date):
+        super().__init__()
+        self.extraction = extraction
+        self.index_date = index_date
+
+    def __missing__(self, name):
+        values = self.extraction._column(self.extraction.study.variables[name], self.index_date, self)
+        self[name] = values
+        return values
+
+
+### 3. Variable evaluators ###
+
+# Each takes (extraction, variable, index_date, columns) and returns an array aligned to extraction.patient_ids
+
+
+def _periods(extraction, table):
+    # The registration or address in force per patient, from each row's start_date/end_date period
+    return extraction.states(table, table, "start_date", "end_date")
+
+
+def registered_as_of(extraction, variable, index_date, columns):
+    date = resolve_date(variable.arg(0, "reference_date"), index_date)
+    return (_periods(extraction, "registrations").rows_as_of(date) >= 0).astype(int)
+
+
+def died_from_any_cause(extraction, variable, index_date, columns):
+    # Dead as of the end of the window and not yet dead the day before it starts
+    deaths = extraction.states("died", "patients", "date_of_death")
+    start, end = window(variable, index_date)
+    died = deaths.rows_as_of(end) >= 0
+    if start is not None:
+        died &= deaths.rows_as_of(np.datetime64(start, "D") - 1) < 0
+    return died.astype(int)
+
+
+def age_as_of(extraction, variable, index_date, columns):
+    table = extraction.tables["patients"]
+    date = pd.Timestamp(resolve_date(variable.arg(0, "reference_date"), index_date))
+    birth = pd.to_datetime(table["date_of_birth"])
+    age = date.year - birth.dt.year - ((birth.dt.month > date.month) | ((birth.dt.month == date.month) & (birth.dt.day > date.day)))
+    result = np.zeros(extraction.size, dtype=int)
+    result[table["_position"].to_numpy()] = age.to_numpy()
+    return result
+
+
+def sex(extraction, variable, index_date, columns):
+    table = extraction.tables["patients"]
+    result = np.full(extraction.size, "", dtype=object)
+    result[table["_position"].to_numpy()] = table["sex"].to_numpy()
+    return result
+
+
+def with_these_clinical_events(extraction, variable, index_date, columns):
+    codelist = variable.arg(0, "codelist")
+    table = extraction.tables["clinical_events"]
+    matches = extraction.filter(variable, "clinical_events", lambda t: t["ctv3_code"].isin(codelist.categories).to_numpy())
+    start, end = window(variable, index_date)
+    returning = variable.kwargs.get("returning", "binary_flag")
+    if returning != "category":
+        return _returning_count(extraction.count(extraction.events(variable.name, "clinical_events", "date", matches), start, end), returning)
+    if start is None and not variable.kwargs.get("find_first_match_in_period"):
+        # The last match on or before the end is the match in force as of the end
+        rows = extraction.states(variable.name, "clinical_events", "date", matches=matches).rows_as_of(end)
+        found = rows >= 0
+        # The category of every match, looked up once rather than at every index date
+        categories = extraction.filter(variable, "clinical_events", lambda t: t["ctv3_code"][matches].map(codelist.categories).to_numpy(dtype=object), "categories")
+        result = np.full(extraction.size, "", dtype=object)
+        result[found] = categories[rows[found]]
+        return result
+    mask = matches & _in_window(table["date"].to_numpy(dtype="datetime64[D]"), start, end)
+    positions = table["_position"].to_numpy()[mask]
+    codes = table["ctv3_code"].to_numpy()[mask]
+    if variable.kwargs.get("find_first_match_in_period"):
+        first = np.append(True, positions[1:] != positions[:-1])
+        positions, codes = positions[first], codes[first]
+    categories = np.array([codelist.categories[c] for c in codes], dtype=object)
+    return extraction.last_value(positions, categories, "")
+
+
+def with_ethnicity_from_sus(extraction, variable, index_date, columns):
+    table = extraction.tables["sus_ethnicity"]
+    table = table[table["group_6"] != ""]
+    # Most frequent code per patient (ties go to the lowest code)
+    counts = table.groupby(["_position", "group_6"]).size().reset_index(name="n")
+    counts = counts.sort_values(["_position", "n", "group_6"], ascending=[True, True, False], kind="mergesort")
+    return extraction.last_value(counts["_position"].to_numpy(), counts["group_6"].to_numpy(), "")
+
+
+def registered_practice_as_of(extraction, variable, index_date, columns):
+    table = extraction.tables["registrations"]
+    date = resolve_date(variable.arg(0, "date"), index_date)
+    # Rows are sorted by start date, so the latest registration wins
+    return _periods(extraction, "registrations").as_of(date, table["region"].to_numpy(), "")
+
+
+def address_as_of(extraction, variable, index_date, columns):
+    table = extraction.tables["addresses"]
+    date = resolve_date(variable.arg(0, "date"), index_date)
+    returning = variable.kwargs["returning"]
+    if returning == "index_of_multiple_deprivation":
+        rows = _periods(extraction, "addresses").rows_as_of(date)
+        found = rows >= 0
+        values = table[returning].to_numpy()[rows[found]].astype(float)
+        step = variable.kwargs.get("round_to_nearest")
+        if step:
+            # Half up, as SQL ROUND does (np.round would take 26250 down to 26200)
+            values = np.floor(values / step + 0.5) * step
+        result = np.zeros(extraction.size, dtype=int)
+        result[found] = values.astype(int)
+        return result
+    return _periods(extraction, "addresses").as_of(date, table[returning].to_numpy(), "")
+
+
+def with_gp_consultations(extraction, variable, index_date, columns):
+    start, end = window(variable, index_date)
+    counts = extraction.count(extraction.events("gp_consultations", "gp_consultations", "date"), start, end)
+    return _returning_count(counts, variable.kwargs.get("returning", "binary_flag"))
+
+
+def admitted_to_hospital(extraction, variable, index_date, columns):
+    return extraction.admissions(variable, index_date)
+
+
+def satisfying(extraction, variable, index_date, columns):
+    return expressions.evaluate(variable.arg(0, "expression"), columns).astype(int)
+
+
+def categorised_as(extraction, variable, index_date, columns):
+    return expressions.categorise(variable.arg(0, "category_definitions"), columns, extraction.size)
+
+
+def _returning_count(counts, returning):
+    if returning == "binary_flag":
+        return (counts > 0).astype(int)
+    if returning == "number_of_matches_in_period":
+        return counts
+    raise NotImplementedError("returning={!r} is not supported locally".format(returning))
+
+
+# The table each evaluator reads (satisfying and categorised_as only read other variables)
+SOURCE_TABLES = {
+    "registered_as_of": "registrations",
+    "died_from_any_cause": "patients",
+    "age_as_of": "patients",
+    "sex": "patients",
+    "with_these_clinical_events": "clinical_events",
+    "with_ethnicity_from_sus": "sus_ethnicity",
+    "registered_practice_as_of": "registrations",
+    "address_as_of": "addresses",
+    "with_gp_consultations": "gp_consultations",
+    "admitted_to_hospital": "apcs",
+}
+
+EVALUATORS = {
+    "registered_as_of": registered_as_of,
+    "died_from_any_cause": died_from_any_cause,
+    "age_as_of": age_as_of,
+    "sex": sex,
+    "with_these_clinical_events": with_these_clinical_events,
+    "with_ethnicity_from_sus": with_ethnicity_from_sus,
+    "registered_practice_as_of": registered_practice_as_of,
+    "address_as_of": address_as_of,
+    "with_gp_consultations": with_gp_consultations,
+    "admitted_to_hospital": admitted_to_hospital,
+    "satisfying": satisfying,
+    "categorised_as": categorised_as,
+}
+
+
+### 4. Run from the command line ###
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the study population for every index date in one pass")
+    parser.add_argument("--tables-dir", required=True, help="Directory of EHR tables (see ehr_tables.py)")
+    parser.add_argument("--study-definition", default="analysis/study_definition.py")
+    parser.add_argument("--start", help="First index date (default: the study index_date)")
+    parser.add_argument("--end", help="Last index date (default: the study end_date)")
+    parser.add_argument("--output", default="output/longitudinal/cohort_long.csv.gz", help="Output file; .csv.gz, .csv, .feather or .parquet")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Where compiled codelists are cached")
+    parser.add_argument("--incremental", action="store_true", help="Cache every extracted column and on reruns only recompute columns whose definition, codelists, index date or data have changed")
+    parser.add_argument("--trace", help="Record each variable's time, rows read and memory at every index date in this JSON lines file, with a summary ranking variables by cost in <trace>_summary.csv")
+    parser.add_argument("--cube-dir", help="Write one aggregated cube_YYYY-MM-DD file per month here (in the format of --output) instead of patient-level rows")
+    parser.add_argument("--monthly-dir", help="Also write one input_YYYY-MM-DD file per month here (in the same format), as generate_cohort does")
+    parser.add_argument("--workers", type=int, default=None, help="Index dates extracted in parallel, by processes forked from the prepared extraction (default: all cores; 1 for none)")
+    parser.add_argument("--step-days", type=int, help="Index dates every this many days (e.g. 7 for weekly) rather than every month")
+    parser.add_argument("--window-days", type=int, help="Count admissions and GP consultations over this many days from each index date rather than its month, as rolling windows (default: --step-days, if given)")
+    args = parser.parse_args()
+    window_days = args.window_days or args.step_days
+
+    # Imported here as session.py builds on Extraction
+    from session import Session
+
+    with Session(args.study_definition, args.tables_dir, args.cache_dir, args.incremental, bool(args.trace), args.workers, window_days) as session:
+        study = session.study
+        index_dates = study.index_dates(args.start, args.end, args.step_days)
+        if args.cube_dir:
+            # Counts by date and every breakdown only; no patient-level rows are kept or written
+            os.makedirs(args.cube_dir, exist_ok=True)
+            for index_date, cube in session.cubes(index_dates):
+                write_cube(cube, cube_path(args.cube_dir, index_date, output_format(args.output)))
+            _report(session.column_cache, session.tracer, args.trace)
+            return
+
+        cohort = pd.concat([month for _, month in session.months(index_dates)], ignore_index=True)
+        _report(session.column_cache, session.tracer, args.trace)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    write_cohort(cohort, args.output, study)
+    if args.monthly_dir:
+        os.makedirs(args.monthly_dir, exist_ok=True)
+        fmt = output_format(args.output)
+        for date, month in cohort.groupby("date", sort=True):
+            write_cohort(month.drop(columns="date"), os.path.join(args.monthly_dir, "input_{}.{}".format(date, fmt)), study)
+
+
+def _report(column_cache, tracer, trace_path):
+    if column_cache is not None:
+        print("Reused {} cached columns, computed {}".format(column_cache.hits, column_cache.misses))
+    if tracer is not None:
+        summary = tracer.write(trace_path)
+        print(summary.head(10).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#######################################
+### Generate measures ###
+#######################################
+
+# Purpose: To produce the measure_<id>.csv files that `cohortextractor generate_measures` makes from the monthly cohort files, but reading each month once for all measures. The study definition declares many Measures over the same few numerators and group_by keys (population, sex, region and sex, ...), so each month is grouped once by the union of every group_by key, summing every numerator and denominator. Each measure is then a roll-up of that small table over the keys it does not use, and small number suppression is applied to all measures and months together. The number of measures barely affects the run time.
+
+# Monthly cubes written by longitudinal.py --cube-dir can be used instead of cohort files, as long as every group_by key is one of the cube dimensions (see cube.py).
+
+# Example: python analysis/measures.py --input-dir output/measures --output-dir output/measure_tables
+
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from cohort_io import iter_cohort, read_cohort
+from cube import INPUT_FILE, input_files, read_cube, rollup
+from definition import load_study
+from disclosure import is_small_total, protect
+
+
+### 1. Group each month once ###
+
+
+def sweep_columns(measures):
+    """The union of group_by keys, and of numerators and denominators, over every measure ("population" is a count of rows)."""
+    keys, counts = [], []
+    for measure in measures:
+        for key in measure["group_by"]:
+            if key != "population" and key not in keys:
+                keys.append(key)
+        for count in (measure["numerator"], measure["denominator"]):
+            if count != "population" and count not in counts:
+                counts.append(count)
+    return keys, counts
+
+
+def total(table, keys):
+    """Sum every other column within each combination of keys (or overall if there are none)."""
+    if not keys:
+        return table.sum(numeric_only=True).to_frame().T
+    return table.groupby(keys, dropna=False, sort=False).sum().reset_index()
+
+
+def group(cohort, keys, counts):
+    table = cohort[keys + counts].copy()
+    table["population"] = 1
+    return total(table, keys)
+
+
+def sweep_file(path, keys, counts, chunksize=None):
+    """Group one monthly file by every key, summing every count (streamed in chunks of chunksize rows if given)."""
+    kind, date = INPUT_FILE.search(os.path.basename(path)).group(1, 2)
+    if kind == "cube":
+        table = rollup(read_cube(path), keys or ["date"]).rename(columns={"pop": "population"})[keys + counts + ["population"]]
+    elif chunksize:
+        table = None
+        for chunk in iter_cohort(path, columns=keys + counts, chunksize=chunksize):
+            partial_table = group(chunk, keys, counts)
+            table = partial_table if table is None else total(pd.concat([table, partial_table], ignore_index=True), keys)
+    else:
+        table = group(read_cohort(path, columns=keys + counts), keys, counts)
+    table["date"] = date
+    return table
+
+
+def sweep(paths, measures, workers=None, chunksize=None):
+    """The grouped table for every month, one month per worker."""
+    keys, counts = sweep_columns(measures)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        tables = list(pool.map(partial(sweep_file, keys=keys, counts=counts, chunksize=chunksize), paths))
+    return pd.concat(tables, ignore_index=True)
+
+
+### 2. Derive every measure ###
+
+
+def derive(swept, measures):
+    """Roll the grouped table up to each measure, stacked into one table with generic numerator and denominator columns."""
+    stacked = []
+    for measure in measures:
+        group_by = [key for key in measure["group_by"] if key != "population"]
+        table = total(swept[group_by + [measure["numerator"], measure["denominator"], "date"]].copy(), group_by + ["date"])
+        table = table.rename(columns={measure["numerator"]: "numerator", measure["denominator"]: "denominator"})
+        table.insert(0, "id", measure["id"])
+        stacked.append(table)
+    stacked = pd.concat(stacked, ignore_index=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stacked["value"] = stacked["numerator"] / stacked["denominator"]
+    return stacked
+
+
+### 3. Small number suppression ###
+
+
+def suppress(stacked, ids):
+    """cohortextractor's small number suppression, for the measures in ids, over every measure and month at once.
+
+    Within each measure and month, numerators and denominators between 1 and 5 are removed. If those removed add up to 5 or less, the smallest value above 5 is removed too, so the small values cannot be recovered from a total (disclosure.is_small_total; measure counts are not rounded, so the standardised tables' rule does not apply). The value is removed wherever its numerator or denominator is.
+    """
+    applies = stacked["id"].isin(ids).to_numpy()
+    protected = protect(stacked[applies], ["numerator", "denominator"], ["id", "date"], linked={"numerator": ["value"], "denominator": ["value"]}, zero=False, exposes=is_small_total)
+    return pd.concat([protected, stacked[~applies]]).loc[stacked.index]
+
+
+### 4. Save output ###
+
+
+def write_measures(stacked, measures, directory):
+    """One measure_<id>.csv per measure, with the numerator and denominator under their own names."""
+    os.makedirs(directory, exist_ok=True)
+    for measure in measures:
+        group_by = [key for key in measure["group_by"] if key != "population"]
+        table = stacked[stacked["id"] == measure["id"]].drop(columns="id")
+        table = table[group_by + ["numerator", "denominator", "value", "date"]]
+        table = table.rename(columns={"numerator": measure["numerator"], "denominator": measure["denominator"]})
+        table.to_csv(os.path.join(directory, "measure_{}.csv".format(measure["id"])), index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate every Measure in the study definition from the monthly cohort files")
+    parser.add_argument("--input-dir", default="output/measures", help="Directory of input_YYYY-MM-DD cohort files or cube_YYYY-MM-DD cubes")
+    parser.add_argument("--output-dir", default="output/measures")
+    parser.add_argument("--study-definition", default="analysis/study_definition.py")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--chunksize", type=int, default=None, help="Stream each file in chunks of this many rows to bound memory (default: read whole files)")
+    args = parser.parse_args()
+
+    # As in cohortextractor, a later measure with the same id replaces an earlier one
+    measures = list({measure["id"]: measure for measure in load_study(args.study_definition).measures}.values())
+    paths = input_files(args.input_dir)
+    if not paths:
+        raise FileNotFoundError("No input_YYYY-MM-DD cohort files or cube_YYYY-MM-DD cubes in {}".format(args.input_dir))
+
+    stacked = derive(sweep(paths, measures, args.workers, args.chunksize), measures)
+    stacked = suppress(stacked, [measure["id"] for measure in measures if measure["small_number_suppression"]])
+    write_measures(stacked, measures, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
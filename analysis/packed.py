@@ -0,0 +1,210 @@
+#######################################
+### Packed cohort months ###
+#######################################
+
+# Purpose: To hold a month of patients in about ten bytes per patient, so that a whole country's month fits in memory and can be aggregated without ever building a DataFrame of Python strings. The layout is derived from the study definition (see cohort_io.column_type):
+# - Binary flags (the admitted_* outcomes and the registered / has_died intermediates of the population) are bit-packed into one byte
+# - Integers keep a small type: age as int8, counts such as gp_count as their uint16 storage type
+# - Categories (sex, region, ethnicity, ...) are stored as uint8 codes into a dictionary shared by every month packed with the same schema (code 0 is missing)
+# The population is evaluated from the packed flags and age, and cubes (see cube.py) are counted straight from the codes.
+
+# Age is signed because a patient registered before their date of birth has a negative age, which is in the population (age <= 120) but in no age group. Integers outside their type's range are stored as its nearest end (ages over 127 as 127), which keeps both the population and the age groups unchanged.
+
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import expressions
+from cohort_io import column_type
+from cube import AGE_BREAKS, AGE_GROUPS, BREAKDOWNS, DIMENSIONS, _as_text
+
+
+FLAG_BITS = 8
+MAX_CATEGORIES = 255  # Codes 1-255 in a uint8, with 0 for missing
+MAX_DENSE_CELLS = 1 << 22  # Beyond this many possible cube cells, only the cells that occur are numbered
+
+
+### 1. Schema ###
+
+
+def population_variables(study):
+    """Names of the variables the population condition uses (e.g. registered, has_died, age)."""
+    return expressions.names(study.population.arg(0, "expression"))
+
+
+class Schema:
+    """How each variable is packed: a bit for each flag, its own integer type, or a code into a shared dictionary."""
+
+    def __init__(self, study, names=None):
+        if names is None:
+            names = population_variables(study) + [v.name for v in study.output_variables]
+        self.flags = []
+        self.integers = OrderedDict()
+        self.categories = OrderedDict()
+        for name in OrderedDict.fromkeys(names):
+            variable = study.variables[name]
+            dtype = column_type(variable)
+            if dtype == "bool":
+                self.flags.append(name)
+            elif dtype == "category":
+                # Start from the expected categories so the codes do not depend on which values turn up first
+                self.categories[name] = sorted(variable.return_expectations.get("category", {}).get("ratios", {}))
+            elif variable.function == "age_as_of":
+                self.integers[name] = np.dtype(np.int8)
+            else:
+                self.integers[name] = np.dtype(dtype)
+        if len(self.flags) > FLAG_BITS:
+            raise ValueError("Only {} flags fit in a byte: {}".format(FLAG_BITS, ", ".join(self.flags)))
+        self._lookup = {name: {value: code for code, value in enumerate(values)} for name, values in self.categories.items()}
+        self._static_codes = {}
+
+    @property
+    def names(self):
+        return self.flags + list(self.integers) + list(self.categories)
+
+    def encode(self, name, values):
+        """Category values -> uint8 codes, adding unseen values to the dictionary."""
+        # Only the distinct values are converted to text (as the cube groups them)
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        uniques = _as_text(np.asarray(uniques))
+        lookup = self._lookup[name]
+        for value in uniques:
+            if value is not None and value not in lookup:
+                if len(lookup) == MAX_CATEGORIES:
+                    raise ValueError("{} has more than {} categories".format(name, MAX_CATEGORIES))
+                lookup[value] = len(lookup)
+                self.categories[name].append(value)
+        mapping = np.array([0 if value is None else lookup[value] + 1 for value in uniques] + [0], dtype=np.uint8)
+        return mapping[codes]  # The -1 for missing picks the final 0
+
+    def pack(self, columns, static=()):
+        """Pack name -> values (a DataFrame or evaluated columns) into a PackedCohort.
+
+        Categories named in static have the same values every time they are packed (e.g. sex), so are only encoded the first time.
+        """
+        flags = None
+        for bit, name in enumerate(self.flags):
+            values = (np.asarray(columns[name]) != 0).astype(np.uint8) << bit
+            flags = values if flags is None else flags | values
+        integers = OrderedDict()
+        for name, dtype in self.integers.items():
+            limits = np.iinfo(dtype)
+            integers[name] = np.clip(np.asarray(columns[name]), limits.min, limits.max).astype(dtype)
+        codes = OrderedDict()
+        for name in self.categories:
+            if name not in static:
+                codes[name] = self.encode(name, columns[name])
+                continue
+            if name not in self._static_codes:
+                self._static_codes[name] = self.encode(name, columns[name])
+            codes[name] = self._static_codes[name]
+        return PackedCohort(self, flags, integers, codes)
+
+
+### 2. Packed months ###
+
+
+class PackedCohort:
+    """One month of patients as packed arrays (row i is the same patient in every array)."""
+
+    def __init__(self, schema, flags, integers, codes):
+        self.schema = schema
+        self.flags = flags
+        self.integers = integers
+        self.codes = codes
+
+    def __len__(self):
+        for values in [self.flags] + list(self.integers.values()) + list(self.codes.values()):
+            if values is not None:
+                return len(values)
+        return 0
+
+    @property
+    def nbytes(self):
+        arrays = [self.flags] + list(self.integers.values()) + list(self.codes.values())
+        return sum(values.nbytes for values in arrays if values is not None)
+
+    # a. Reading columns back #
+
+    def column(self, name):
+        """Values of one variable: flags as 0/1, integers as int64, categories as text (None if missing)."""
+        if name in self.schema.flags:
+            return (self.flags >> self.schema.flags.index(name)) & 1
+        if name in self.integers:
+            return self.integers[name].astype(np.int64)
+        labels = np.array([None] + self.schema.categories[name], dtype=object)
+        return labels[self.codes[name]]
+
+    def columns(self):
+        return _Unpacked(self)
+
+    def to_frame(self):
+        return pd.DataFrame({name: self.column(name) for name in self.schema.names})
+
+    def population(self, study):
+        """Mask of the patients in the study population, evaluated from the packed columns."""
+        return expressions.evaluate(study.population.arg(0, "expression"), self.columns()).astype(bool)
+
+    # b. Aggregation #
+
+    def aggregate(self, date, counts, where=None):
+        """The cube of these patients (as cube.aggregate), counted directly from the packed columns.
+
+        Each row's cell is a single integer combining its age group and category codes, so every count is one bincount.
+        """
+        rows = slice(None) if where is None else np.asarray(where, dtype=bool)
+        dimensions = [("age_group", _AGE_CODES[self.integers["age"][rows].view(np.uint8)], _AGE_LABELS)]
+        for name in ["sex"] + list(BREAKDOWNS.values()):
+            dimensions.append((name, self.codes[name][rows], np.array([None] + self.schema.categories[name], dtype=object)))
+
+        cells = np.zeros(len(dimensions[0][1]), dtype=np.int64)
+        size = 1
+        for _, codes, labels in dimensions:
+            cells = cells * len(labels) + codes
+            size *= len(labels)
+        if size > MAX_DENSE_CELLS:
+            occupied, cells = np.unique(cells, return_inverse=True)
+        else:
+            occupied = None
+        population = np.bincount(cells, minlength=0 if occupied is not None else size)
+        # Cells in order of first appearance, as groupby(sort=False) gives, so later steps see rows in the same order
+        first = np.full(len(population), len(cells), dtype=np.int64)
+        np.minimum.at(first, cells, np.arange(len(cells)))
+        present = np.flatnonzero(population)
+        present = present[np.argsort(first[present], kind="stable")]
+
+        cube = OrderedDict([("date", np.full(len(present), date, dtype=object))])
+        remaining = present if occupied is None else occupied[present]
+        for name, _, labels in reversed(dimensions):
+            cube[name] = labels[remaining % len(labels)]
+            remaining = remaining // len(labels)
+        cube = pd.DataFrame(cube)[DIMENSIONS]
+        for count in counts:
+            if count in self.schema.flags:
+                weights = (self.flags[rows] >> self.schema.flags.index(count)) & 1
+            else:
+                weights = self.integers[count][rows]
+            cube[count] = np.bincount(cells, weights=weights, minlength=len(population))[present].astype(np.int64)
+        cube["pop"] = population[present].astype(np.int64)
+        return cube
+
+
+class _Unpacked(dict):
+    # Variable name -> unpacked values, unpacking each column the first time the expression looks it up
+
+    def __init__(self, packed):
+        super().__init__()
+        self.packed = packed
+
+    def __missing__(self, name):
+        values = self.packed.column(name)
+        self[name] = values
+        return values
+
+
+# Age group code (1 upwards, 0 for missing) for every int8 age, indexed by its bits read as a uint8
+_AGE_LABELS = np.array([None] + AGE_GROUPS, dtype=object)
+_AGES = np.arange(256, dtype=np.uint8).view(np.int8).astype(np.int64)
+_AGE_CODES = np.where((_AGES >= AGE_BREAKS[0]) & (_AGES <= AGE_BREAKS[-1]), np.searchsorted(AGE_BREAKS[1:-1], _AGES, side="left") + 1, 0).astype(np.int64)
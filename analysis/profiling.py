@@ -0,0 +1,66 @@
+#######################################
+### Extraction trace ###
+#######################################
+
+# Purpose: To find out which variables make an extraction slow. When tracing is switched on (longitudinal.py --trace), every variable evaluated at every index date is recorded with its time, the number of table rows it read, the peak memory allocated while evaluating it and the size of its result. Variables that do not depend on the index date are recorded once (index_date "static"), and the first evaluation of the others, which also builds the indexes and scans shared by every index date, as "prepare". The records are written as a JSON lines trace file, with a summary table ranking variables by their total time.
+
+# Memory is measured with tracemalloc, which slows evaluation down, so tracing is opt-in and timings are best compared with each other rather than with untraced runs.
+
+
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+class Tracer:
+    """Collects one record per variable per index date."""
+
+    def __init__(self):
+        self.records = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def measure(self, **fields):
+        """Time and measure the block; fields (and anything the block adds to the yielded record) are saved with it."""
+        record = dict(fields)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield record
+        record["seconds"] = time.perf_counter() - start
+        record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - before
+        self.records.append(record)
+
+    def summary(self):
+        """Per variable: total and mean time, share of all time, rows read, the largest peak memory and the time spent once (static or in prepare), most expensive first."""
+        trace = pd.DataFrame(self.records)
+        summary = trace.groupby(["variable", "function"], sort=False).agg(
+            evaluations=("seconds", "size"),
+            total_seconds=("seconds", "sum"),
+            mean_seconds=("seconds", "mean"),
+            rows=("rows", "sum"),
+            peak_bytes=("peak_bytes", "max"),
+            result_bytes=("result_bytes", "max"),
+        )
+        summary.insert(2, "share", summary["total_seconds"] / summary["total_seconds"].sum())
+        one_off = trace["index_date"].isin(["static", "prepare"])
+        summary["one_off_seconds"] = trace["seconds"].where(one_off, 0).groupby([trace["variable"], trace["function"]], sort=False).sum()
+        return summary.sort_values("total_seconds", ascending=False).reset_index()
+
+    def write(self, path):
+        """Write the trace (JSON lines) to path and the summary next to it as <path>_summary.csv."""
+        with open(path, "w") as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + "\n")
+        summary = self.summary()
+        summary.to_csv(_summary_path(path), index=False)
+        return summary
+
+
+def _summary_path(path):
+    stem = path[:-len(".jsonl")] if path.endswith(".jsonl") else path
+    return stem + "_summary.csv"
@@ -0,0 +1,226 @@
+#######################################
+### Stratified-sample trends ###
+#######################################
+
+# Purpose: To produce the standardised_*_trends.csv tables from a sample of patients while codelists or breakdowns are being changed, so each change can be checked in minutes rather than after a full extraction and standardisation, with confidence intervals that the full run can be checked against:
+# - Every patient is put in a stratum by age group x sex x region x IMD quintile (as at the study index_date; none of these depend on the index date in this study) and the same fraction is drawn from every stratum, with at least two patients from each. The draw is seeded, so the same seed and tables always give the same sample
+# - Only the sampled patients' records are read and extracted (see session.py), and every cube cell is weighted by its stratum's population over its sample size, so the weighted counts and populations estimate those of the whole population
+# - The weighted cube is standardised exactly as in a full run (see standardise.py, including rounding and suppression), and the standardised tables get dsr_<measure>_lower95_0cl and dsr_<measure>_upper95_0cl columns: a 95% interval for the sampling error of the directly standardised rate per 100,000 (dexp / std_pop, as the describing_trends scripts calculate it). sex_trends.csv is written too, with weighted counts but no intervals
+# The variance of each age group's rate is that of a ratio estimator from a stratified sample (Taylor linearised, with finite population correction); age groups are sampled separately, so the rate's variance is the sum of theirs weighted by the standard population squared.
+
+# Example: python analysis/sampling.py --tables-dir data/ehr --fraction 0.05 --output-dir output/sample --compare output/measures
+
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from cube import BREAKDOWNS, MEASURES, _as_text, age_group, count_columns, rollup
+from definition import STUDY_DEFINITION, load_study
+from ehr_tables import TABLES, read_table
+from longitudinal import Extraction
+from session import Session
+from standardise import OUTPUT_FILES, standardise, write_outputs
+
+
+### 1. Draw the sample ###
+
+# Cube dimension -> study variable for each stratification variable
+STRATA = {
+    "age_group": "age",
+    "sex": "sex",
+    "region": "region",
+    "imd_quintile": "imd_quintile",
+}
+
+# Tables the strata (and the population) are evaluated from
+FRAME_TABLES = ["patients", "registrations", "addresses"]
+
+# Patients drawn from each stratum at the least, so every stratum has a variance
+MIN_PER_STRATUM = 2
+
+
+def sampling_frame(study, tables):
+    """Every patient's stratum, as a DataFrame of patient_id and the STRATA columns."""
+    extraction = Extraction(study, {name: tables[name] for name in FRAME_TABLES})
+    varying = sorted(set(STRATA.values()) & extraction.varying)
+    if varying:
+        raise ValueError("Cannot stratify by {}: it depends on the index date".format(", ".join(varying)))
+    columns = extraction.evaluate(study.index_dates()[0], list(STRATA.values()))
+    frame = pd.DataFrame({"patient_id": extraction.patient_ids, "age_group": age_group(columns["age"])})
+    for dimension in ["sex", "region", "imd_quintile"]:
+        frame[dimension] = _as_text(columns[STRATA[dimension]])
+    return frame
+
+
+def draw(frame, fraction, seed):
+    """The sampled patients, with the size of their stratum (N) and of its sample (n).
+
+    Each patient gets a random key (in patient_id order, from the seed) and the patients with the smallest keys in each stratum are taken.
+    """
+    frame = frame.assign(_key=np.random.default_rng(seed).random(len(frame)))
+    groups = frame.groupby(list(STRATA), dropna=False, sort=False)
+    size = groups["patient_id"].transform("size").to_numpy()
+    n = np.minimum(size, np.maximum(MIN_PER_STRATUM, np.ceil(fraction * size))).astype(np.int64)
+    taken = groups["_key"].rank(method="first").to_numpy() <= n
+    return frame[taken].drop(columns="_key").assign(N=size[taken], n=n[taken]).reset_index(drop=True)
+
+
+def strata(sample):
+    """N and n for each stratum."""
+    return sample.groupby(list(STRATA), dropna=False, sort=False)[["N", "n"]].first().reset_index()
+
+
+### 2. Extract the sample ###
+
+
+def extract(study_definition, tables_dir, fraction, seed, start=None, end=None, workers=None):
+    """Draw the sample and extract it; returns its (unweighted) cube for every index date and its strata."""
+    study = load_study(study_definition)
+    tables = {name: read_table(tables_dir, name) for name in FRAME_TABLES}
+    sample = draw(sampling_frame(study, tables), fraction, seed)
+    patient_ids = sample["patient_id"].to_numpy()
+    tables = {name: tables[name][tables[name]["patient_id"].isin(patient_ids)] if name in tables else read_table(tables_dir, name, patient_ids) for name in TABLES}
+    with Session(study_definition, workers=workers, tables=tables) as session:
+        cubes = [cube for _, cube in session.cubes(session.study.index_dates(start, end))]
+    return pd.concat(cubes, ignore_index=True), strata(sample)
+
+
+### 3. Weight and standardise ###
+
+
+def weight(cube, strata):
+    """Scale every count in the cube by its stratum's N / n."""
+    weights = _merge_strata(cube, strata)
+    weighted = cube.copy()
+    for column in count_columns(cube):
+        weighted[column] = cube[column].to_numpy(dtype=float) * weights["N"] / weights["n"]
+    return weighted
+
+
+def _merge_strata(table, strata):
+    weights = table[list(STRATA)].merge(strata, on=list(STRATA), how="left", sort=False)
+    if weights["n"].isna().any():
+        raise ValueError("Cube cells in strata that were not sampled")
+    return {"N": weights["N"].to_numpy(dtype=float), "n": weights["n"].to_numpy(dtype=float)}
+
+
+def standardise_sample(cube, strata):
+    """standardise.standardise on the weighted cube, with 95% intervals for each standardised rate."""
+    weighted = weight(cube, strata)
+    outputs = standardise(weighted)
+    std = rollup(weighted, ["age_group", "sex", "date"])[["age_group", "sex", "date", "pop"]].rename(columns={"pop": "std_pop"})
+    for name, variable in BREAKDOWNS.items():
+        errors = standard_errors(cube, strata, std, variable)
+        table = outputs[name].merge(errors, on=["sex", variable, "date"], how="left", sort=False)
+        for measure in MEASURES:
+            dsr = table["dexp_" + measure] / table["std_pop"] * 100000
+            table["dsr_{}_lower95_0cl".format(measure)] = np.maximum(dsr - 1.96 * table["se_" + measure], 0)
+            table["dsr_{}_upper95_0cl".format(measure)] = dsr + 1.96 * table["se_" + measure]
+        outputs[name] = table.drop(columns=["se_" + m for m in MEASURES])
+    return outputs
+
+
+### 4. Sampling error ###
+
+
+def standard_errors(cube, strata, std, variable):
+    """Standard error of every measure's directly standardised rate (per 100,000) by sex, level of variable and date.
+
+    cube is the unweighted sample cube and std the estimated standard population by age group, sex and date.
+    """
+    domain = ["sex", variable, "date", "age_group"]
+    cells = cube.groupby(list(dict.fromkeys(domain + list(STRATA))), dropna=False, sort=False)[MEASURES + ["pop"]].sum().reset_index()
+    weights = _merge_strata(cells, strata)
+    N, n = weights["N"][:, None], weights["n"][:, None]
+    k = cells[MEASURES].to_numpy(dtype=float)
+    m = cells[["pop"]].to_numpy(dtype=float)
+
+    # Estimated population and rate of each age group in each domain
+    group = cells.groupby(domain, dropna=False, sort=False).ngroup().to_numpy()
+    first = np.unique(group, return_index=True)[1]
+    population = np.zeros((len(first), 1))
+    np.add.at(population, group, N / n * m)
+    rate = np.zeros((len(first), len(MEASURES)))
+    np.add.at(rate, group, N / n * k)
+    rate /= population
+
+    # Each stratum's variance of the linearised residuals (outcome - rate, over the sampled patients in the domain and zero for the rest)
+    r = rate[group]
+    total = k - r * m
+    squares = k * (1 - r) ** 2 + (m - k) * r ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spread = np.where(n > 1, (squares - total ** 2 / n) / (n - 1), 0)
+    variance = np.zeros_like(rate)
+    np.add.at(variance, group, N ** 2 * (1 - n / N) * spread / n)
+    variance /= population ** 2
+
+    # Combine the age groups with the standard population
+    keys = cells.loc[first, domain].reset_index(drop=True)
+    std_pop = keys.merge(std, on=["age_group", "sex", "date"], how="left", sort=False)[["std_pop"]].to_numpy(dtype=float)
+    row = keys.groupby(domain[:-1], dropna=False, sort=False).ngroup().to_numpy()
+    rows = np.unique(row, return_index=True)[1]
+    weighted = np.zeros((len(rows), len(MEASURES)))
+    np.add.at(weighted, row, std_pop ** 2 * variance)
+    std_total = np.zeros((len(rows), 1))
+    np.add.at(std_total, row, std_pop)
+
+    errors = keys.loc[rows, domain[:-1]].reset_index(drop=True)
+    se = np.sqrt(weighted) / std_total * 100000
+    for i, measure in enumerate(MEASURES):
+        errors["se_" + measure] = se[:, i]
+    return errors
+
+
+### 5. Check a full run ###
+
+
+def compare(sample_dir, full_dir):
+    """For each standardised table and measure, how many of the full run's rates are within the sample's intervals."""
+    results = []
+    for name, variable in BREAKDOWNS.items():
+        keys = ["sex", variable, "date"]
+        sample = _read_output(sample_dir, name, keys)
+        full = _read_output(full_dir, name, keys)
+        table = sample.merge(full, on=keys, how="inner", suffixes=("", "_full"))
+        for measure in MEASURES:
+            rate = table["dexp_{}_full".format(measure)] / table["std_pop_full"] * 100000
+            low, upp = table["dsr_{}_lower95_0cl".format(measure)], table["dsr_{}_upper95_0cl".format(measure)]
+            known = rate.notna() & low.notna()
+            within = (rate >= low) & (rate <= upp)
+            results.append({"table": OUTPUT_FILES[name], "measure": measure, "rates": int(known.sum()), "within": int((known & within).sum())})
+    results = pd.DataFrame(results)
+    results["share"] = results["within"] / results["rates"]
+    return results
+
+
+def _read_output(directory, name, keys):
+    return pd.read_csv(os.path.join(directory, OUTPUT_FILES[name]), index_col=0, dtype={key: str for key in keys})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Standardised trends with confidence intervals from a stratified sample of patients")
+    parser.add_argument("--tables-dir", required=True, help="Directory of EHR tables (see ehr_tables.py)")
+    parser.add_argument("--study-definition", default=STUDY_DEFINITION)
+    parser.add_argument("--fraction", type=float, default=0.05, help="Share of each stratum to sample")
+    parser.add_argument("--seed", type=int, default=2022)
+    parser.add_argument("--start", help="First index date (default: the study index_date)")
+    parser.add_argument("--end", help="Last index date (default: the study end_date)")
+    parser.add_argument("--workers", type=int, default=None, help="Index dates extracted in parallel (default: all cores; 1 for none)")
+    parser.add_argument("--output-dir", default="output/sample")
+    parser.add_argument("--compare", help="Directory of a full run's standardised tables to check against the intervals")
+    args = parser.parse_args()
+    if not 0 < args.fraction <= 1:
+        parser.error("--fraction must be between 0 and 1")
+
+    cube, sample_strata = extract(args.study_definition, args.tables_dir, args.fraction, args.seed, args.start, args.end, args.workers)
+    write_outputs(standardise_sample(cube, sample_strata), args.output_dir)
+    print("Sampled {} patients from {} strata".format(int(sample_strata["n"].sum()), len(sample_strata)))
+    if args.compare:
+        print(compare(args.output_dir, args.compare).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#######################################
+### Extraction sessions ###
+#######################################
+
+# Purpose: To load and plan a study definition once and then extract any stream of index dates from it. Each generate_cohort run re-imports study_definition.py, re-reads every codelist and re-plans every variable, once for each of the 40 index dates. A session does all of that once:
+# - the study definition is parsed and its codelists read once
+# - the EHR tables are read and sorted once, and the order variables are evaluated in is worked out once
+# - prepare() then builds everything that does not depend on the index date: the compiled codelist index, codelist and admission method filters, the shared admissions scans and every date-independent variable (sex, ethnicity_sus, ...)
+# Index dates are handed to a pool of worker processes forked from the prepared session, so every worker starts with all of that already in memory (shared with the parent until written to) and each month only costs its date-dependent work. Results come back in the order the dates were given.
+
+# Example:
+#   with Session("analysis/study_definition.py", "data/ehr", workers=8) as session:
+#       for index_date, cube in session.cubes(session.study.index_dates()):
+#           ...
+
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from codelist_index import CACHE_DIR
+from column_cache import ColumnCache
+from definition import STUDY_DEFINITION, load_study
+from ehr_tables import load_tables, tables_version
+from longitudinal import Extraction, roll_windows
+from profiling import Tracer
+
+
+# The session a worker process was forked from (set by the pool initialiser)
+_SESSION = None
+
+
+class Session:
+    """A study definition and EHR tables loaded and prepared once, extracting index dates on a pool of workers.
+
+    workers=1 extracts in this process; otherwise the pool (default: one worker per core) is started the first time it is needed and kept until close().
+    With window_days, variables that look at the month from the index date look at that many days instead, counted as rolling windows (see longitudinal.roll_windows).
+    tables are EHR tables already in memory (e.g. a sample of patients, see sampling.py) to use instead of reading tables_dir.
+    """
+
+    def __init__(self, study_definition=STUDY_DEFINITION, tables_dir=None, cache_dir=CACHE_DIR, incremental=False, trace=False, workers=None, window_days=None, tables=None):
+        self.study = load_study(study_definition)
+        if window_days:
+            roll_windows(self.study, window_days)
+        column_cache = ColumnCache(os.path.join(cache_dir, "columns"), tables_version(tables_dir)) if incremental else None
+        if tables is None:
+            tables = load_tables(tables_dir)
+        self.extraction = Extraction(self.study, tables, cache_dir, column_cache, Tracer() if trace else None, rolling=bool(window_days))
+        self.workers = workers or os.cpu_count()
+        self.schema = self.extraction.cube_schema()
+        self._prepared = False
+        self._pool = None
+
+    @property
+    def column_cache(self):
+        return self.extraction.column_cache
+
+    @property
+    def tracer(self):
+        return self.extraction.tracer
+
+    def prepare(self):
+        if not self._prepared:
+            self.extraction.prepare()
+            self._prepared = True
+        return self
+
+    # a. Extracting index dates #
+
+    def months(self, index_dates):
+        """Yield (index date, population DataFrame) for each index date, as Extraction.month."""
+        return self._map("month", index_dates)
+
+    def cubes(self, index_dates):
+        """Yield (index date, cube) for each index date, as Extraction.cube."""
+        return self._map("cube", index_dates)
+
+    def _map(self, kind, index_dates):
+        self.prepare()
+        if self.workers == 1:
+            for index_date in index_dates:
+                yield index_date, self._extract(kind, index_date)[0]
+            return
+        index_dates = list(index_dates)
+        for index_date, (result, hits, misses, records) in zip(index_dates, self._workers().map(partial(_extract, kind), index_dates)):
+            # Fold the workers' cache counts and trace records into this session's
+            if self.column_cache is not None:
+                self.column_cache.hits += hits
+                self.column_cache.misses += misses
+            if self.tracer is not None:
+                self.tracer.records.extend(records)
+            yield index_date, result
+
+    def _extract(self, kind, index_date):
+        """Extract one index date, returning the result with the column cache hits and misses and trace records it added."""
+        cache, tracer = self.column_cache, self.tracer
+        hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        traced = len(tracer.records) if tracer is not None else 0
+        if kind == "cube":
+            result = self.extraction.cube(index_date, self.schema)
+        else:
+            result = self.extraction.month(index_date)
+        if cache is not None:
+            hits, misses = cache.hits - hits, cache.misses - misses
+        return result, hits, misses, tracer.records[traced:] if tracer is not None else []
+
+    # b. Worker pool #
+
+    def _workers(self):
+        if self._pool is None:
+            # Forked, so workers share the prepared tables, filters and columns rather than rebuilding them
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"), initializer=_attach, initargs=(self,))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _attach(session):
+    global _SESSION
+    _SESSION = session
+
+
+def _extract(kind, index_date):
+    return _SESSION._extract(kind, index_date)
+
@@ -0,0 +1,206 @@
+######################################
+### Age- and sex-standardise trends ###
+######################################
+
+# Purpose: To produce the standardised_*_trends.csv and sex_trends.csv tables made by create_age_standardised_outputs.R / age_standardise_month.R, but in one grouped pass rather than one script run per month and one copy of the code per breakdown. Each month's cohort file is aggregated once (in parallel, one month per worker) to counts by date, age group, sex and every breakdown. Cubes written by longitudinal.py --cube-dir are already aggregated and are used as they are (see cube.py). The standard population rates, indirect (iexp_) and direct (dexp_) expected counts are then calculated for every measure and every breakdown together as array operations on that small table.
+
+# The disclosure rules start from those in age_standardise_month.R: counts are rounded to the nearest 5 before standardising, rows with a population <= 5 are dropped and counts <= 5 are blanked along with their expected counts. On top of that, secondary suppression stops blanked counts from being worked out from the sex totals (see disclosure.py).
+
+# Example: python analysis/standardise.py --input-dir output/measures --output-dir output/standardised
+
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from cohort_io import iter_cohort, read_cohort
+from cube import BREAKDOWNS, INPUT_COLUMNS, INPUT_FILE, MEASURES, aggregate, input_files, merge_cubes, read_cube, rollup
+from disclosure import protect, round_counts
+
+
+### 1. Aggregate each month to a cube ###
+
+
+def aggregate_file(path, chunksize=None):
+    """Aggregate one monthly file, either all at once or streamed in chunks of chunksize rows.
+
+    Files that are already cubes are read as they are. When streaming, only the running per-group sums are kept between chunks, so memory depends on the number of groups rather than the number of patients. The sums are integers, so the result is exactly the same either way.
+    """
+    kind, date = INPUT_FILE.search(os.path.basename(path)).group(1, 2)
+    if kind == "cube":
+        return read_cube(path)
+    if not chunksize:
+        return aggregate(read_cohort(path, columns=INPUT_COLUMNS), date=date)
+    cube = None
+    for chunk in iter_cohort(path, columns=INPUT_COLUMNS, chunksize=chunksize):
+        partial_cube = aggregate(chunk, date=date)
+        cube = partial_cube if cube is None else merge_cubes([cube, partial_cube])
+    return cube if cube is not None else aggregate(read_cohort(path, columns=INPUT_COLUMNS), date=date)
+
+
+def build_cube(paths, workers=None, chunksize=None):
+    """Aggregate many monthly files in a process pool; the result is small (a few thousand cells per month)."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        cubes = list(pool.map(partial(aggregate_file, chunksize=chunksize), paths))
+    return pd.concat(cubes, ignore_index=True)
+
+
+### 2. Standardise ###
+
+
+def standard_population(cube):
+    """Population and rates for each measure by age group, sex and date (the standard)."""
+    std = rollup(cube, ["age_group", "sex", "date"]).rename(columns={"pop": "std_pop"})
+    rates = std[MEASURES].to_numpy(dtype=float) / std[["std_pop"]].to_numpy(dtype=float)
+    for i, measure in enumerate(MEASURES):
+        std[measure + "_rate"] = rates[:, i]
+    return std[["age_group", "sex", "date", "std_pop"] + [m + "_rate" for m in MEASURES]]
+
+
+def standardise(cube):
+    """Return {breakdown name: table} for every breakdown, plus "sex" for the unstandardised totals."""
+    std = standard_population(cube)
+
+    # Stack every breakdown into one table so the expected counts are calculated once for all of them
+    stacked = []
+    for name, variable in BREAKDOWNS.items():
+        table = rollup(cube, ["age_group", "sex", variable, "date"]).rename(columns={variable: "level"})
+        table.insert(0, "breakdown", name)
+        stacked.append(table)
+    stacked = pd.concat(stacked, ignore_index=True)
+
+    # Round counts to nearest 5 (for disclosure purposes as requested by OpenSAFELY team)
+    counts = round_counts(stacked[MEASURES].to_numpy())
+    pop = round_counts(stacked["pop"].to_numpy())[:, None]
+
+    # Join on standard population data and calculate expected counts for all measures at once
+    stacked = stacked.merge(std, on=["age_group", "sex", "date"], how="left", sort=False)
+    rates = stacked[[m + "_rate" for m in MEASURES]].to_numpy(dtype=float)
+    std_pop = stacked[["std_pop"]].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iexp = pop * rates  # Indirect method: expected rate x population
+        dexp = counts / pop * std_pop  # Direct method: observed rate x standard population
+
+    values = pd.DataFrame(index=stacked.index)
+    for i, measure in enumerate(MEASURES):
+        values[measure] = counts[:, i]
+        values["iexp_" + measure] = iexp[:, i]
+        values["dexp_" + measure] = dexp[:, i]
+    values["pop"] = pop[:, 0]
+    values["std_pop"] = std_pop[:, 0]
+    keys = stacked[["breakdown", "sex", "level", "date"]]
+
+    # Sum over age groups (NaN from empty groups is skipped, as with na.rm = TRUE)
+    summed = pd.concat([keys, values], axis=1).groupby(["breakdown", "sex", "level", "date"], dropna=False, sort=False).sum(min_count=0).reset_index()
+
+    outputs = {}
+    for name, variable in BREAKDOWNS.items():
+        table = summed[summed["breakdown"] == name].drop(columns="breakdown").rename(columns={"level": variable})
+        outputs[name] = _order(suppress(table, ["date", "sex"]), ["date", "sex", variable])
+    outputs["sex"] = _order(suppress(_sex_totals(cube), None), ["date", "sex"])
+    return outputs
+
+
+def _sex_totals(cube):
+    # Totals by sex (these do not need standardising)
+    table = rollup(cube, ["sex", "date"])[["sex", "date"] + MEASURES + ["pop"]]
+    for column in MEASURES + ["pop"]:
+        table[column] = round_counts(table[column])
+    return table
+
+
+### 3. Disclosure control ###
+
+
+def suppress(table, totals):
+    """Drop rows with pop <= 5 and blank counts <= 5 with their own expected counts, plus whatever else is needed so they cannot be recovered from the totals (see disclosure.py).
+
+    totals are the columns of the published total each row adds up to: for a breakdown, the sex_trends.csv row for the same date and sex (None for sex_trends.csv itself).
+    """
+    linked = {measure: ["iexp_" + measure, "dexp_" + measure] for measure in MEASURES}
+    return protect(table, MEASURES, totals, linked=linked, population="pop")
+
+
+def _order(table, by):
+    # Only M and F are released; sort so output does not depend on worker scheduling
+    table = table[table["sex"].isin(["M", "F"])]
+    return table.sort_values(by, kind="mergesort", key=_sort_key).reset_index(drop=True)
+
+
+def _sort_key(column):
+    numbers = pd.to_numeric(column, errors="coerce")
+    return numbers if numbers.notna().all() else column.astype(str)
+
+
+### 4. Save output ###
+
+
+OUTPUT_FILES = {
+    "imd": "standardised_imd_trends.csv",
+    "region": "standardised_region_trends.csv",
+    "urbrur": "standardised_urbrur_trends.csv",
+    "ethnicity": "standardised_ethnicity_trends.csv",
+    "sex": "sex_trends.csv",
+}
+
+
+def write_outputs(outputs, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, table in outputs.items():
+        write_table(table, os.path.join(directory, OUTPUT_FILES[name]))
+
+
+def write_table(table, path):
+    """Write a table as R's write.csv does: a quoted header, a leading column of quoted row numbers, text quoted, numbers as R prints them and NA for missing values.
+
+    Categories that are all numbers (e.g. imd_quintile) are written as numbers, as they were read as numbers by the R scripts.
+    """
+    columns = [['"{}"'.format(i) for i in range(1, len(table) + 1)]] + [_r_column(table[name]) for name in table.columns]
+    lines = [",".join(_r_quote(name) for name in [""] + list(table.columns))]
+    lines.extend(",".join(row) for row in zip(*columns))
+    with open(path, "w", newline="") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _r_column(column):
+    numbers = pd.to_numeric(column, errors="coerce")
+    if pd.api.types.is_numeric_dtype(column) or numbers.notna().sum() == column.notna().sum():
+        return ["NA" if np.isnan(value) else _r_number(value) for value in numbers.to_numpy(dtype=float)]
+    return ["NA" if pd.isna(value) else _r_quote(value) for value in column]
+
+
+def _r_quote(value):
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def _r_number(value):
+    # 15 significant digits, in fixed notation unless scientific is shorter (R's default, scipen = 0)
+    mantissa, exponent = "{:.14e}".format(value).split("e")
+    mantissa = mantissa.rstrip("0").rstrip(".")
+    exponent = int(exponent)
+    scientific = "{}e{}{:02d}".format(mantissa, "-" if exponent < 0 else "+", abs(exponent))
+    digits = len(mantissa.replace("-", "").replace(".", ""))
+    fixed = "{:.{}f}".format(value, max(0, digits - 1 - exponent))
+    return fixed if len(fixed) <= len(scientific) else scientific
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Age- and sex-standardise the monthly cohort files")
+    parser.add_argument("--input-dir", default="output/measures", help="Directory of input_YYYY-MM-DD cohort files or cube_YYYY-MM-DD cubes")
+    parser.add_argument("--output-dir", default="output/measures")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--chunksize", type=int, default=None, help="Stream each file in chunks of this many rows to bound memory (default: read whole files)")
+    args = parser.parse_args()
+
+    paths = input_files(args.input_dir)
+    if not paths:
+        raise FileNotFoundError("No input_YYYY-MM-DD cohort files or cube_YYYY-MM-DD cubes in {}".format(args.input_dir))
+    write_outputs(standardise(build_cube(paths, args.workers, args.chunksize)), args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#######################################
+### Generate synthetic EHR tables ###
+#######################################
+
+# Purpose: To generate synthetic versions of the patient record tables that the study definition queries (see ehr_tables.py), so that extraction (longitudinal.py, duckdb_backend.py) can be run, tested and profiled at any size outside the secure environment. Unlike the dummy cohort files from dummy_data.py, these are the raw records - registration and address histories, coded events, GP consultations, hospital admissions, SUS ethnicity and deaths - so every step of extraction has real work to do. The values are plausible rather than realistic:
+# - ages follow the England population (as dummy_data.py), with deaths more likely at older ages
+# - registrations and addresses are histories of one to three periods, the last usually still open
+# - regions and rural/urban classifications follow the ratios in the study definition's return_expectations
+# - coded events, consultations and admissions arrive at a constant rate over the table period; a share of the events are ethnicity codes, and a share of the admissions are emergencies with a primary diagnosis from one of the avoidable hospitalisation codelists (sometimes with an extra character, as ICD-10 codes match by prefix)
+
+# Patients are generated in chunks from a seed for each chunk, so memory depends on the chunk size rather than the number of patients, and the same arguments always give the same tables.
+
+# Example: python analysis/synthetic_ehr.py --patients 1000000 --output-dir output/ehr --format parquet
+
+
+import argparse
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from definition import load_study
+from dummy_data import population_ages
+from ehr_tables import TABLES
+
+
+FORMATS = ("csv", "csv.gz", "parquet")
+
+# Yearly rates per patient
+CONSULTATIONS_PER_YEAR = 5.0
+EVENTS_PER_YEAR = 2.0
+ADMISSIONS_PER_YEAR = 0.15
+
+ETHNICITY_RECORDED = 0.6  # Share of patients with at least one ethnicity code
+SUS_ETHNICITY_RECORDED = 0.5
+EMERGENCY_SHARE = 0.7  # Share of admissions that are emergencies
+AVOIDABLE_SHARE = 0.3  # Share of admissions with a diagnosis from one of the ICD-10 codelists
+ELECTIVE_METHODS = ["11", "12", "13"]
+MOVES = [0.8, 0.15, 0.05]  # Chance of one, two or three registration (or address) periods
+IMD_RANKS = 32844
+
+# A letter and three digits (e.g. Q800), drawn from for every code that should match no codelist
+OTHER_CODES = np.array(["{}{:03d}".format(letter, number) for letter in "ABCDEFGHJKLMNPQRSTUVWXYZ" for number in range(1000)], dtype=object)
+
+
+### 1. Study-specific values ###
+
+
+class Vocabulary:
+    """The codes and categories the tables are drawn from, read from the study definition."""
+
+    def __init__(self, study):
+        variables = list(study.variables.values())
+        self.regions = _ratios(variables, "registered_practice_as_of", {"North East": 1.0})
+        self.rural_urban = _ratios([v for v in variables if v.kwargs.get("returning") == "rural_urban_classification"], "address_as_of", {"Urban": 0.8, "Rural": 0.2})
+        methods = [m for v in variables if v.function == "admitted_to_hospital" for m in v.kwargs.get("with_admission_method") or []]
+        self.emergency_methods = list(dict.fromkeys(methods)) or ["21"]
+        self.diagnoses = sorted({code for c in study.codelists.values() if c.system == "icd10" for code in c.codes})
+        ethnicity = [c for c in study.codelists.values() if c.system == "ctv3"]
+        self.ethnicity_codes = [code for c in ethnicity for code in c.codes]
+
+
+def _ratios(variables, function, default):
+    for variable in variables:
+        if variable.function == function and "category" in variable.return_expectations:
+            return variable.return_expectations["category"]["ratios"]
+    return default
+
+
+def _choose(rng, ratios, size):
+    values = list(ratios)
+    probabilities = np.array([ratios[v] for v in values], dtype=float)
+    return np.array(values, dtype=object)[rng.choice(len(values), size=size, p=probabilities / probabilities.sum())]
+
+
+### 2. One chunk of patients ###
+
+
+def _days(dates):
+    return np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+
+
+def _dates(days):
+    return np.asarray(days, dtype=np.int64).astype("datetime64[D]")
+
+
+def _events(rng, patient_ids, start, end, per_year):
+    # Patient ids and days for events at a constant rate between start and end (days, per patient)
+    years = np.maximum(end - start, 0) / 365.25
+    counts = rng.poisson(per_year * years)
+    ids = np.repeat(patient_ids, counts)
+    first, width = np.repeat(start, counts), np.repeat(np.maximum(end - start, 0), counts)
+    return ids, first + np.floor(rng.random(len(ids)) * (width + 1)).astype(np.int64)
+
+
+def _periods(rng, patient_ids, first, end):
+    # One to three consecutive periods per patient from first, the last open unless the patient left (about 5%)
+    counts = rng.choice(len(MOVES), size=len(patient_ids), p=MOVES) + 1
+    ids = np.repeat(patient_ids, counts)
+    starts = np.repeat(first, counts)
+    span = np.repeat(np.maximum(end - first, 1), counts)
+    # Later periods start at sorted random points of the patient's time, so they follow each other
+    later = np.ones(len(ids), dtype=bool)
+    later[np.cumsum(counts) - counts] = False
+    starts = np.where(later, starts + np.floor(rng.random(len(ids)) * span).astype(np.int64), starts)
+    order = np.lexsort((starts, ids))
+    ids, starts = ids[order], starts[order]
+    last = np.append(ids[1:] != ids[:-1], True)
+    ends = np.append(starts[1:] - 1, 0).astype(float)
+    ends[last] = np.where(rng.random(last.sum()) < 0.05, end[np.searchsorted(patient_ids, ids[last])] - np.floor(rng.random(last.sum()) * 365), np.nan)
+    ends[~last & (ends < starts)] = np.nan  # Two periods starting on the same day overlap
+    ends = np.where(ends < starts, starts, ends)
+    return ids, starts, ends
+
+
+def _codes(rng, size):
+    # Random codes that are in no codelist
+    return OTHER_CODES[rng.integers(0, len(OTHER_CODES), size)]
+
+
+def generate_chunk(vocabulary, first_id, size, seed, chunk, start, end):
+    """Every table for one chunk of patients, as name -> DataFrame (with the columns in ehr_tables.TABLES)."""
+    rng = np.random.default_rng(np.random.SeedSequence([seed, chunk]))
+    ids = np.arange(first_id, first_id + size, dtype=np.int64)
+    start, end = _days(start), _days(end)
+    tables = {}
+
+    # a. Patients #
+    age = population_ages(rng, size).astype(np.int64)
+    birth = end - age * 365 - rng.integers(0, 365, size)
+    dies = rng.random(size) < np.minimum(1.0, 1e-4 * np.exp(0.085 * age)) * (end - start) / 365.25
+    death = np.where(dies, start + np.floor(rng.random(size) * (end - start + 1)), np.nan)
+    tables["patients"] = pd.DataFrame({
+        "patient_id": ids,
+        "sex": _choose(rng, {"F": 0.51, "M": 0.49}, size),
+        "date_of_birth": _dates(birth),
+        "date_of_death": pd.to_datetime(_dates(np.nan_to_num(death).astype(np.int64))).where(dies),
+    })
+    last = np.where(dies, np.nan_to_num(death).astype(np.int64), end)
+
+    # b. Registrations and addresses (the first period starts at birth or up to 20 years before the tables start) #
+    first = np.maximum(birth, start - rng.integers(0, 20 * 365, size))
+    for name, column, values in [("registrations", "region", vocabulary.regions), ("addresses", "rural_urban_classification", vocabulary.rural_urban)]:
+        period_ids, starts, ends = _periods(rng, ids, first, last)
+        table = pd.DataFrame({
+            "patient_id": period_ids,
+            "start_date": _dates(starts),
+            "end_date": pd.to_datetime(_dates(np.nan_to_num(ends).astype(np.int64))).where(~np.isnan(ends)),
+        })
+        if name == "addresses":
+            table["index_of_multiple_deprivation"] = rng.integers(1, IMD_RANKS + 1, len(table))
+        table[column] = _choose(rng, values, len(table))
+        tables[name] = table[TABLES[name]]
+
+    # c. Coded events (ethnicity and others), consultations and admissions #
+    coded = np.maximum(first, birth)
+    event_ids, event_days = _events(rng, ids, coded, last, EVENTS_PER_YEAR)
+    codes = _codes(rng, len(event_ids))
+    recorded = rng.random(size) < ETHNICITY_RECORDED
+    ethnicity_ids = ids[recorded]
+    ethnicity_days = coded[recorded] + np.floor(rng.random(recorded.sum()) * (last[recorded] - coded[recorded] + 1)).astype(np.int64)
+    ethnicity = np.array(vocabulary.ethnicity_codes or ["XaJSE"], dtype=object)[rng.integers(0, max(len(vocabulary.ethnicity_codes), 1), recorded.sum())]
+    tables["clinical_events"] = pd.DataFrame({
+        "patient_id": np.concatenate([event_ids, ethnicity_ids]),
+        "date": _dates(np.concatenate([event_days, ethnicity_days])),
+        "ctv3_code": np.concatenate([codes, ethnicity]),
+    })
+
+    visit_ids, visit_days = _events(rng, ids, np.maximum(start, birth), last, CONSULTATIONS_PER_YEAR)
+    tables["gp_consultations"] = pd.DataFrame({"patient_id": visit_ids, "date": _dates(visit_days)})
+
+    admission_ids, admission_days = _events(rng, ids, np.maximum(start, birth), last, ADMISSIONS_PER_YEAR)
+    emergency = rng.random(len(admission_ids)) < EMERGENCY_SHARE
+    methods = np.where(emergency, np.array(vocabulary.emergency_methods, dtype=object)[rng.integers(0, len(vocabulary.emergency_methods), len(emergency))],
+                       np.array(ELECTIVE_METHODS, dtype=object)[rng.integers(0, len(ELECTIVE_METHODS), len(emergency))])
+    avoidable = (rng.random(len(admission_ids)) < AVOIDABLE_SHARE) & (len(vocabulary.diagnoses) > 0)
+    listed = np.array(vocabulary.diagnoses or ["I10"], dtype=object)[rng.integers(0, max(len(vocabulary.diagnoses), 1), len(admission_ids))]
+    # Three-character codes sometimes get a fourth, which still matches by prefix
+    listed = np.where((pd.Series(listed).str.len().to_numpy() == 3) & (rng.random(len(listed)) < 0.5), listed + rng.integers(0, 10, len(listed)).astype(str).astype(object), listed)
+    tables["apcs"] = pd.DataFrame({
+        "patient_id": admission_ids,
+        "admission_date": _dates(admission_days),
+        "admission_method": methods,
+        "primary_diagnosis": np.where(avoidable, listed, _codes(rng, len(admission_ids))),
+    })
+
+    # d. SUS ethnicity (one to three records, which may disagree) #
+    sus = ids[rng.random(size) < SUS_ETHNICITY_RECORDED]
+    sus = np.repeat(sus, rng.integers(1, 4, len(sus)))
+    tables["sus_ethnicity"] = pd.DataFrame({"patient_id": sus, "group_6": rng.integers(1, 6, len(sus)).astype(str).astype(object)})
+    return tables
+
+
+### 3. Write the tables ###
+
+
+class TableWriter:
+    """Append chunks to one file per table (csv, csv.gz or parquet)."""
+
+    def __init__(self, directory, fmt):
+        self.directory = directory
+        self.format = fmt
+        self._writers = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, "{}.{}".format(name, self.format))
+
+    def write(self, tables):
+        for name, table in tables.items():
+            if self.format in ("csv", "csv.gz"):
+                # Dates as YYYY-MM-DD, missing dates as empty fields
+                for column in table.columns:
+                    if pd.api.types.is_datetime64_any_dtype(table[column]):
+                        table[column] = table[column].dt.strftime("%Y-%m-%d")
+                table.to_csv(self.path(name), index=False, mode="a" if name in self._writers else "w", header=name not in self._writers)
+                self._writers[name] = True
+                continue
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            arrow = pa.Table.from_pandas(table, preserve_index=False)
+            if name not in self._writers:
+                self._writers[name] = pq.ParquetWriter(self.path(name), arrow.schema, compression="zstd")
+            self._writers[name].write_table(arrow.cast(self._writers[name].schema))
+
+    def close(self):
+        for writer in self._writers.values():
+            if writer is not True:
+                writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic EHR tables for local extraction")
+    parser.add_argument("--patients", type=int, default=100000)
+    parser.add_argument("--output-dir", default="output/ehr")
+    parser.add_argument("--format", default="parquet", choices=FORMATS)
+    parser.add_argument("--study-definition", default="analysis/study_definition.py")
+    parser.add_argument("--start", default="2018-01-01", help="First date of consultations, events and admissions")
+    parser.add_argument("--end", help="Last date of any record (default: the study end_date)")
+    parser.add_argument("--seed", type=int, default=2022)
+    parser.add_argument("--chunksize", type=int, default=250000, help="Patients generated at a time (this, with the seed, determines the values)")
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    vocabulary = Vocabulary(study)
+    end = args.end or study.constants["end_date"]
+    os.makedirs(args.output_dir, exist_ok=True)
+    with TableWriter(args.output_dir, args.format) as writer:
+        for chunk, first in enumerate(range(0, args.patients, args.chunksize)):
+            writer.write(generate_chunk(vocabulary, first + 1, min(args.chunksize, args.patients - first), args.seed, chunk, datetime.date.fromisoformat(args.start), datetime.date.fromisoformat(end)))
+    for name in TABLES:
+        print(writer.path(name))
+
+
+if __name__ == "__main__":
+    main()
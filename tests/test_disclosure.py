@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "analysis"))
+
+from disclosure import is_pinned, is_small_total, protect  # noqa: E402
+from measures import suppress  # noqa: E402
+
+
+def suppressed(counts, zero=True, exposes=None):
+    table = pd.DataFrame({"g": [1] * len(counts), "c": counts})
+    return protect(table, ["c"], ["g"], zero=zero, exposes=exposes)["c"].isna().tolist()
+
+
+@pytest.mark.parametrize("counts, expected", [
+    # Both removed cells must be 5, so a third is removed
+    ([5, 5, 40, 60, 90], [True, True, True, False, False]),
+    # Both removed cells must be 0
+    ([0, 0, 40, 60, 90], [True, True, True, False, False]),
+    # 0 + 5 could be either way round, so nothing more is removed
+    ([5, 0, 40, 60, 90], [True, True, False, False, False]),
+    # A single removed cell is always recoverable, whatever its value
+    ([5, 40, 60, 90, 100], [True, True, False, False, False]),
+    ([0, 40, 60, 90, 100], [True, True, False, False, False]),
+    # Nothing removed
+    ([10, 40, 60, 90, 100], [False] * 5),
+])
+def test_secondary_suppression(counts, expected):
+    assert suppressed(counts) == expected
+
+
+def test_secondary_suppression_without_zeros():
+    # With zeros left in, each removed count is at least 1, so 1 + 1 is pinned but 1 + 5 is not
+    assert suppressed([1, 1, 0, 40, 60], zero=False) == [True, True, False, True, False]
+    assert suppressed([1, 5, 0, 40, 60], zero=False) == [True, True, False, False, False]
+
+
+def test_is_pinned():
+    totals = np.array([0, 5, 10, 5, 15, 10])
+    cells = np.array([0, 1, 2, 2, 3, 3])
+    assert is_pinned(totals, cells).tolist() == [False, True, True, False, True, False]
+
+
+def test_is_small_total():
+    totals = np.array([0, 5, 6, 5, 10])
+    cells = np.array([0, 1, 1, 2, 2])
+    assert is_small_total(totals, cells).tolist() == [False, True, False, True, False]
+
+
+def test_rules_differ():
+    # 1 + 4 is not pinned, but adds up to 5 or less
+    assert suppressed([1, 4, 0, 40, 60], zero=False) == [True, True, False, False, False]
+    assert suppressed([1, 4, 0, 40, 60], zero=False, exposes=is_small_total) == [True, True, False, True, False]
+
+
+def test_measure_suppression():
+    # cohortextractor's rule, within each measure and month, for numerators and denominators separately
+    stacked = pd.DataFrame({
+        "id": ["m"] * 8,
+        "date": ["2019-01-01"] * 4 + ["2019-02-01"] * 4,
+        "numerator": [1, 4, 10, 20, 3, 3, 10, 20],
+        "denominator": [100, 100, 100, 100, 100, 100, 100, 100],
+    })
+    stacked["value"] = stacked["numerator"] / stacked["denominator"]
+    result = suppress(stacked, ["m"])
+    assert result["numerator"].isna().tolist() == [True, True, True, False, True, True, False, False]
+    assert result["value"].isna().tolist() == result["numerator"].isna().tolist()
+    assert result["denominator"].notna().all()